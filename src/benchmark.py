@@ -0,0 +1,318 @@
+#!/usr/bin/python3 -u
+
+""" Benchmark of Hugo 2 Gopher and Gemini (benchmark.py)
+
+    Generates a synthetic Hugo output tree (as the Hugo-2-Gopher-and-Gemini
+    theme would) and runs hugo2gg.py over it with --no-hugo, reporting the
+    throughput and the wall time of each phase. Each run is a new process,
+    so it starts with cold caches.
+
+    Copyright (C) 2021 Mike Marin -- All Rights Reserved
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3 of the License.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    You can contact me at mmarin <at> acm <dot> org
+"""
+
+import os
+import sys
+import re
+import json
+import time
+import shutil
+import random
+import getopt
+import subprocess
+
+hugo2gg = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hugo2gg.py")
+
+## Phases of hugo2gg.py that are timed (see --stats of hugo2gg.py)
+phases = ['fix_hugo_nested_paths', 'traverse_site', 'traverse_gopher', 'traverse_gemini',
+        'wait_conversions', 'save_build_cache', 'dedupe_assets', 'check_links',
+        'update_search_index']
+
+words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua ut enim ad minim veniam quis nostrud "
+         "exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis aute irure "
+         "in reprehenderit voluptate velit esse cillum fugiat nulla pariatur").split()
+
+pagesPerSection = 1000 # Keep the folders of the synthetic site small
+listPages = 10         # Pages linked by the list of posts (as the paginator of Hugo)
+
+
+class Site_shape:
+    #### Size and content of the synthetic site
+
+    def __init__(this):
+        this.pages = 1000        # Number of pages (each one both as gopher and gemini)
+        this.lines = 40          # Lines of text per page
+        this.links = 1           # Links per line
+        this.shortcodes = 2      # Hugo shortcodes per page
+        this.fenced = 1          # Fenced code blocks per page
+        this.tags = 2            # Html tags per page
+        this.assets = 100        # Number of static files
+        this.assetSize = 10240   # Size of each static file (bytes)
+        this.seed = 1            # Seed of the random generator
+
+    def asdict(this):
+        return dict(vars(this))
+
+
+def page_folder(shape, number):
+    # Folder of a page, relative to the gopher and gemini folders
+    if shape.pages <= pagesPerSection:
+        return 'posts/p%d' % number
+    return 'posts/s%d/p%d' % (number // pagesPerSection, number)
+
+
+def page_body(rnd, shape, number):
+    # Markdown lines of a page (common to gopher and gemini)
+    lines = []
+    fenced = set(rnd.sample(range(shape.lines), min(shape.fenced, shape.lines)))
+    shortcodes = set(rnd.sample(range(shape.lines), min(shape.shortcodes, shape.lines)))
+    tags = set(rnd.sample(range(shape.lines), min(shape.tags, shape.lines)))
+    for i in range(shape.lines):
+        if i in fenced:
+            lines += ['```', '    x = ' + str(i) + '  # *not* markdown', '```']
+            continue
+        if i % 10 == 0:
+            lines += ['', '## ' + ' '.join(rnd.sample(words, 3))]
+        line = ' '.join(rnd.choice(words) for _ in range(rnd.randint(8, 30)))
+        for j in range(shape.links):
+            if rnd.random() < 0.2:
+                line += ' ![image %d](/images/img%d.png)' % (j, rnd.randrange(max(shape.assets, 1)))
+            elif rnd.random() < 0.5:
+                line += ' [page %d](/%s/)' % (j, page_folder(shape, rnd.randrange(shape.pages)))
+            else:
+                line += ' [site %d](https://example.com/%d)' % (j, rnd.randrange(1000))
+        if i in shortcodes:
+            line += ' {{< youtube id%d >}}' % i
+        if i in tags:
+            line += ' <b>bold <i>text</i></b> &amp; **more** `code`'
+        if rnd.random() < 0.1:
+            line = '- ' + line
+        lines.append(line)
+        if rnd.random() < 0.3:
+            lines.append('')
+    return lines
+
+
+def gopher_page(body, number):
+    out = ['[[[=> page:page,copyPage:false,keepRaw:false,removeExtras:false,ignoreLinks:false,'
+           'fullLine:false,textChar:false,host:localhost,port:70<=]]]',
+           '', 'iPage %d' % number, 'i', 'iJanuary 2021 · 1 minute read', 'i']
+    out += ['i' + line for line in body]
+    out += ['', '[[[=> references <=]]]', 'iSite sections:', '1Home\t/', '1Posts\t/posts/',
+            'i', 'iSocial media links:', 'hGithub\tURL:https://github.com/example/', 'i',
+            '1Return to main page\t/', 'i', 'i Author ', 'icopyright 2021', '']
+    return '\n'.join(out)
+
+
+re_page_link = re.compile(r'\]\((/posts/[^)]*)/\)')
+
+def gemini_page(body, number):
+    # The links to the pages are to their gemini files (/posts/p1.gmi, not /posts/p1/)
+    out = ['[[[=> page:page,copyPage:false,keepRaw:false,removeExtras:false,ignoreLinks:false<=]]]',
+           '', '# Page %d' % number]
+    out += [re_page_link.sub(r'](\1.gmi)', line) for line in body]
+    out += ['', '[[[=> references <=]]]', '## Site sections', '=> /index.gmi  Home',
+            '=> /posts.gmi  Posts', '', '## Social media links',
+            '=> https://github.com/example/  Github', '', '=> /index.gmi  Return to main page',
+            '', ' Author ', 'copyright 2021', '']
+    return '\n'.join(out)
+
+
+def gopher_list(number, title, links):
+    # The home page (number 0) or the list of posts (number 1)
+    out = ['[[[=> page:%s,copyPage:false,keepRaw:false,removeExtras:false,ignoreLinks:false,'
+           'fullLine:false,textChar:false,host:localhost,port:70<=]]]' % ('main', 'list')[number],
+           'i' + title, 'i']
+    out += ['1%s\t%s' % (label, link) for label, link in links]
+    out += ['i', '[[[=> references <=]]]', 'iSite sections:', '1Home\t/', '1Posts\t/posts/', '']
+    return '\n'.join(out)
+
+
+def gemini_list(number, title, links):
+    out = ['[[[=> page:%s,copyPage:false,keepRaw:false,removeExtras:false,ignoreLinks:false<=]]]'
+           % ('main', 'list')[number], '# ' + title, '']
+    out += ['=> %s.gmi %s' % (link.rstrip('/'), label) for label, link in links] ## As converted
+    out += ['', '[[[=> references <=]]]', '## Site sections', '=> /index.gmi  Home',
+            '=> /posts.gmi  Posts', '']
+    return '\n'.join(out)
+
+
+def generate(path, shape):
+    """Generate a synthetic Hugo output tree
+
+    Parameters
+    ----------
+    path : str
+        Folder of the site (it is replaced)
+    shape : Site_shape
+        Size and content of the site
+
+    Returns
+    -------
+    int
+        Number of bytes of the pages
+    """
+
+    rnd = random.Random(shape.seed)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    size = 0
+    for number in range(shape.pages):
+        body = page_body(rnd, shape, number)
+        for folder, name, text in (('gopher', 'gophermap.txt', gopher_page(body, number)),
+                                   ('gemini', 'index.gmi', gemini_page(body, number))):
+            folder = os.path.join(path, folder, *page_folder(shape, number).split('/'))
+            os.makedirs(folder, exist_ok = True)
+            data = text.encode()
+            with open(os.path.join(folder, name), 'wb') as fl:
+                fl.write(data)
+            size += len(data)
+    ## The home page and the list of posts, linked by every page
+    posts = [('Page %d' % number, '/%s/' % page_folder(shape, number))
+            for number in range(min(shape.pages, listPages))]
+    for number, (folder, title, links) in enumerate((('', 'Home', [('Posts', '/posts/')]),
+                                                     ('posts', 'Posts', posts))):
+        for kind, name, text in (('gopher', 'gophermap.txt', gopher_list(number, title, links)),
+                                 ('gemini', 'index.gmi', gemini_list(number, title, links))):
+            target = os.path.join(path, kind, folder)
+            os.makedirs(target, exist_ok = True)
+            data = text.encode()
+            with open(os.path.join(target, name), 'wb') as fl:
+                fl.write(data)
+            size += len(data)
+    folder = os.path.join(path, 'images')
+    os.makedirs(folder, exist_ok = True)
+    for number in range(shape.assets):
+        with open(os.path.join(folder, 'img%d.png' % number), 'wb') as fl:
+            fl.write(rnd.randbytes(shape.assetSize) if hasattr(rnd, 'randbytes')
+                    else os.urandom(shape.assetSize))
+    return size
+
+
+def run(path, args):
+    # Run hugo2gg.py over the site in a new process (so the caches and counters of
+    # a run are not reused by the next one), returning the wall time of the run and
+    # of each phase (from the --stats of the run)
+    statsName = path.rstrip(os.sep) + "-stats.json"
+    argv = ['-n', '-t', 'all', '-p', path, '-g', os.path.join(path, 'gopher'),
+            '-G', os.path.join(path, 'gemini')] + args + ['--stats', statsName]
+    res = subprocess.run([sys.executable, hugo2gg] + argv, stdout = subprocess.DEVNULL)
+    if res.returncode != 0:
+        print("ERROR: hugo2gg.py failed with", res.returncode, file = sys.stderr)
+        sys.exit(2)
+    with open(statsName, 'rt') as fl:
+        stats = json.load(fl)
+    os.remove(statsName)
+    times = dict.fromkeys(phases, 0.0)
+    times.update({name: phase['wall'] for name, phase in stats['phases'].items()})
+    return stats['wall'], times
+
+
+def arguments() :
+    print("Usage:\n ",os.path.basename(sys.argv[0])," [flags] [-- hugo2gg flags]\n\nFlags:")
+    print("   -d, --dir     <path>    Folder of the synthetic site (default to bench-gg)")
+    print("   -p, --pages   <num>     Number of pages (default 1000)")
+    print("   -l, --lines   <num>     Lines of text per page (default 40)")
+    print("   -L, --links   <num>     Links per line (default 1)")
+    print("   -s, --shortcodes <num>  Hugo shortcodes per page (default 2)")
+    print("   -f, --fenced  <num>     Fenced code blocks per page (default 1)")
+    print("   -T, --tags    <num>     Html tags per page (default 2)")
+    print("   -a, --assets  <num>     Number of static files (default 100)")
+    print("   -A, --asset-size <num>  Size in bytes of each static file (default 10240)")
+    print("   -S, --seed    <num>     Seed of the random generator (default 1)")
+    print("   -r, --runs    <num>     Number of runs, the site is generated before each one (default 1)")
+    print("   -o, --output  <file>    Append the results of each run as a json line to <file>")
+    print("   -k, --keep              Keep the synthetic site after the last run")
+    print("   -h, --help              Prints this help")
+    print("\nThe flags after -- are passed to hugo2gg.py (e.g. -- --jobs 4)")
+    sys.exit(2)
+
+
+def main(argv):
+    shape = Site_shape()
+    arDir = "bench-gg"
+    arRuns = 1
+    arOutput = ""
+    arKeep = False
+
+    try:
+        opts, args = getopt.getopt(argv,"hd:p:l:L:s:f:T:a:A:S:r:o:k",
+                ["help","dir=","pages=","lines=","links=","shortcodes=","fenced=","tags=",
+                    "assets=","asset-size=","seed=","runs=","output=","keep"])
+    except getopt.GetoptError as e:
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        arguments()
+
+    try:
+        for opt, arg in opts:
+            if opt in ("-h","--help"):
+                arguments()
+            elif opt in ("-d", "--dir"):
+                arDir = arg
+            elif opt in ("-p", "--pages"):
+                shape.pages = int(arg)
+            elif opt in ("-l", "--lines"):
+                shape.lines = int(arg)
+            elif opt in ("-L", "--links"):
+                shape.links = int(arg)
+            elif opt in ("-s", "--shortcodes"):
+                shape.shortcodes = int(arg)
+            elif opt in ("-f", "--fenced"):
+                shape.fenced = int(arg)
+            elif opt in ("-T", "--tags"):
+                shape.tags = int(arg)
+            elif opt in ("-a", "--assets"):
+                shape.assets = int(arg)
+            elif opt in ("-A", "--asset-size"):
+                shape.assetSize = int(arg)
+            elif opt in ("-S", "--seed"):
+                shape.seed = int(arg)
+            elif opt in ("-r", "--runs"):
+                arRuns = int(arg)
+            elif opt in ("-o", "--output"):
+                arOutput = arg
+            elif opt in ("-k", "--keep"):
+                arKeep = True
+    except ValueError as e:
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        arguments()
+
+    print("Site:", json.dumps(shape.asdict()))
+    print("hugo2gg flags:", ' '.join(args))
+    for number in range(arRuns):
+        start = time.perf_counter()
+        size = generate(arDir, shape)
+        pages = 2 * (shape.pages + 2) ## With the home page and the list of posts
+        print("\nRun", number + 1, "-- generated", pages, "pages (",
+                round(size / 1e6, 2), "MB ) in", round(time.perf_counter() - start, 2), "s")
+        total, times = run(arDir, args)
+        print("    Total:                 %9.3f s  %10.1f pages/s  %8.2f MB/s" %
+                (total, pages / total, size / 1e6 / total))
+        for name in phases:
+            if times[name]:
+                print("    %-22s %9.3f s" % (name + ':', times[name]))
+        if arOutput:
+            with open(arOutput, 'a') as fl:
+                fl.write(json.dumps({'site': shape.asdict(), 'args': args, 'pages': pages,
+                    'bytes': size, 'seconds': total, 'phases': times}) + '\n')
+
+    if not arKeep and os.path.isdir(arDir):
+        shutil.rmtree(arDir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,399 @@
+#!/usr/bin/python3 -u
+
+""" Search of a Gopher hole or a Gemini capsule (ggsearch.py)
+
+    Looks up words in the search index that hugo2gg.py --index writes in the
+    gopher and gemini folders (search.idx), and lists the pages that have all
+    of them: as text, as a gopher menu (for a type 7 selector), or as a gemini
+    page (for a CGI program that asks for input). hugo2gg.py uses this module
+    to write the index.
+
+    Copyright (C) 2021 Mike Marin -- All Rights Reserved
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3 of the License.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    You can contact me at mmarin <at> acm <dot> org
+"""
+
+import os
+import re
+import sys
+import mmap
+import time
+import struct
+import unicodedata
+import getopt
+import urllib.parse
+
+##  Index file ##
+##
+## All the numbers are unsigned 32 bit little endian integers, and the
+## offsets are from the start of the file:
+##
+##    header      'GGINDEX1', number of pages, number of terms, offset of the
+##                page table, offset of the term table, offset and length of
+##                the base (the prefix of the selectors, see hugo2gg.py --base)
+##    strings     base, selectors, titles, and terms (UTF-8)
+##    postings    for each term, the sorted numbers of the pages that have it,
+##                each one as the difference to the previous one (LEB128 varint)
+##    page table  for each page (sorted by selector): offset and length of its
+##                selector, and offset and length of its title
+##    term table  for each term (sorted): offset and length of the term, offset
+##                of its postings, and number of pages that have it
+##
+## So a lookup is a binary search in the term table of the mapped file, and
+## only the postings of the words of the query are decoded.
+
+magic = b'GGINDEX1'
+header = struct.Struct('<8s6I')
+entry = struct.Struct('<4I')
+
+wordPattern = re.compile(r'\w+')
+queryPattern = re.compile(r'\w+\*?')
+minWord = 2  # Shorter words are not indexed
+maxWord = 40 # Neither are longer ones (e.g. hashes)
+
+
+def normalize(text):
+    # So the same words written in other ways (e.g. with combining accents) match
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def words(text):
+    # Set of the words of text that are indexed
+    return {word for word in wordPattern.findall(normalize(text)) if minWord <= len(word) <= maxWord}
+
+
+def page_terms(data, isGemini):
+    # Title (the first line with text) and sorted words of a converted page.
+    # Only the text of the gophermap items (or of the gemini links) is indexed
+    title = ''
+    text = []
+    for line in data.decode('utf-8', 'replace').splitlines():
+        if isGemini:
+            if line.startswith('```'):
+                continue
+            if line.startswith('=>'):
+                parts = line[2:].split(None, 1)
+                line = parts[1] if len(parts) > 1 else ''
+            line = line.lstrip('#>* ')
+        elif '\t' in line:
+            line = line.split('\t', 1)[0][1:]
+        if not title and line.strip():
+            title = line.strip()
+        text.append(line)
+    return title, sorted(words('\n'.join(text)))
+
+
+def encode_postings(numbers):
+    data = bytearray()
+    last = 0
+    for number in numbers:
+        delta = number - last
+        last = number
+        while delta >= 0x80:
+            data.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return data
+
+
+def decode_postings(data, offset, count):
+    numbers = []
+    number = 0
+    for _ in range(count):
+        delta = shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            delta |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        number += delta
+        numbers.append(number)
+    return numbers
+
+
+def write_index(name, pages, base = ''):
+    """Write a search index
+
+    Parameters
+    ----------
+    name : str
+        File name of the index. It is replaced at once, so a lookup
+        never sees it half written
+    pages : dict
+        Selector -> (title, words) of each page
+    base : str
+        Prefix of the selectors in the results (see hugo2gg.py --base)
+
+    Returns
+    -------
+    int
+        Size of the index in bytes
+    """
+
+    selectors = sorted(pages)
+    postings = {}
+    for number, selector in enumerate(selectors):
+        for word in pages[selector][1]:
+            postings.setdefault(word, []).append(number)
+    terms = sorted(postings)
+
+    strings = bytearray()
+    def add(text):
+        offset = header.size + len(strings)
+        data = text.encode('utf-8', 'surrogateescape')
+        strings.extend(data)
+        return offset, len(data)
+
+    baseOffset, baseLength = add(base)
+    pageTable = bytearray()
+    for selector in selectors:
+        pageTable += entry.pack(*add(selector), *add(pages[selector][0]))
+    termStrings = [add(term) for term in terms]
+    blob = bytearray()
+    termTable = bytearray()
+    start = header.size + len(strings)
+    for term, (offset, length) in zip(terms, termStrings):
+        termTable += entry.pack(offset, length, start + len(blob), len(postings[term]))
+        blob += encode_postings(postings[term])
+
+    pageOffset = start + len(blob)
+    with open(name + "-new", 'wb') as fl:
+        fl.write(header.pack(magic, len(selectors), len(terms), pageOffset,
+            pageOffset + len(pageTable), baseOffset, baseLength))
+        fl.write(strings)
+        fl.write(blob)
+        fl.write(pageTable)
+        fl.write(termTable)
+        size = fl.tell()
+    os.replace(name + "-new", name)
+    return size
+
+
+class Search_index:
+    #### Search index (see write_index), mapped in memory
+    ## Raises OSError when the file can not be read, and ValueError when it
+    ## is not a search index
+
+    def __init__(this, name):
+        with open(name, 'rb') as fl:
+            if os.fstat(fl.fileno()).st_size < header.size:
+                raise ValueError(name + " is not a search index")
+            this.data = mmap.mmap(fl.fileno(), 0, access = mmap.ACCESS_READ)
+        (tag, this.pageCount, this.termCount, this.pageTable, this.termTable,
+                baseOffset, baseLength) = header.unpack_from(this.data)
+        if tag != magic:
+            this.close()
+            raise ValueError(name + " is not a search index")
+        this.base = this.string(baseOffset, baseLength)
+
+    def __enter__(this):
+        return this
+
+    def __exit__(this, *args):
+        this.close()
+
+    def close(this):
+        this.data.close()
+
+    def string(this, offset, length):
+        return this.data[offset:offset + length].decode('utf-8', 'surrogateescape')
+
+    def term(this, number):
+        # The term (as bytes), the offset of its postings, and its number of pages
+        offset, length, postings, count = entry.unpack_from(this.data,
+                this.termTable + number * entry.size)
+        return this.data[offset:offset + length], postings, count
+
+    def find(this, key):
+        # Number of the first term that is not less than key (a binary search)
+        low, high = 0, this.termCount
+        while low < high:
+            middle = (low + high) // 2
+            if this.term(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(this, word, prefix = False):
+        # Set of the numbers of the pages with word (or with a word that starts with it)
+        key = word.encode('utf-8', 'surrogateescape')
+        numbers = set()
+        number = this.find(key)
+        while number < this.termCount:
+            term, postings, count = this.term(number)
+            if term != key and not (prefix and term.startswith(key)):
+                break
+            numbers.update(decode_postings(this.data, postings, count))
+            number += 1
+        return numbers
+
+    def page(this, number):
+        # Selector (with the base) and title of a page
+        offset, length, titleOffset, titleLength = entry.unpack_from(this.data,
+                this.pageTable + number * entry.size)
+        return this.base + this.string(offset, length), this.string(titleOffset, titleLength)
+
+    def search(this, query, limit = 50):
+        # Pages with all the words of the query (a word that ends with * matches
+        # the words that start with it). Returns the number of pages found and the
+        # selector and title of the first limit pages, those with more of the words
+        # in their title first
+        found = None
+        exact = set()
+        for word in queryPattern.findall(normalize(query)):
+            prefix = word.endswith('*')
+            word = word.rstrip('*')
+            if not prefix and not minWord <= len(word) <= maxWord:
+                continue
+            if not prefix:
+                exact.add(word)
+            numbers = this.lookup(word, prefix)
+            found = numbers if found is None else found & numbers
+            if not found:
+                break
+        if not found:
+            return 0, []
+        pages = [this.page(number) for number in sorted(found)]
+        pages.sort(key = lambda page: -len(exact & words(page[1])))
+        return len(pages), pages[:limit]
+
+    def pages(this):
+        # Selector (without the base) -> (title, set of words) of every page
+        # (to update the index, see hugo2gg.py)
+        pages = []
+        for number in range(this.pageCount):
+            selector, title = this.page(number)
+            pages.append((selector[len(this.base):], (title, set())))
+        for number in range(this.termCount):
+            term, postings, count = this.term(number)
+            term = term.decode('utf-8', 'surrogateescape')
+            for page in decode_postings(this.data, postings, count):
+                pages[page][1][1].add(term)
+        return dict(pages)
+
+### End Search_index
+
+
+def gopher_results(query, total, results, host, port):
+    # Gopher menu of the results of a search
+    lines = ['iSearch: ' + query, 'i' + str(total) + ' pages found', 'i']
+    lines += ['1' + (title or selector) + '\t' + selector for selector, title in results]
+    if total > len(results):
+        lines += ['i', 'iOnly the first ' + str(len(results)) + ' are listed']
+    lines = [line if '\t' in line else line + '\t' for line in lines]
+    return '\r\n'.join(line + '\t' + host + '\t' + str(port) for line in lines) + '\r\n.\r\n'
+
+
+def gemini_results(query, total, results):
+    # Gemini page of the results of a search
+    lines = ['# Search: ' + query, '', str(total) + ' pages found', '']
+    lines += ['=> ' + urllib.parse.quote(selector) + ' ' + (title or selector)
+            for selector, title in results]
+    if total > len(results):
+        lines += ['', 'Only the first ' + str(len(results)) + ' are listed']
+    return '\n'.join(lines) + '\n'
+
+
+def arguments() :
+    print("Usage:\n ",os.path.basename(sys.argv[0])," [flags] [<word> ...]\n\nFlags:")
+    print("   -i, --index   <file>    Search index (default to $GGSEARCH_INDEX or search.idx)")
+    print("   -f, --format  <format>  Output format (default to text, or to the protocol")
+    print("                           of the server that runs it as a CGI program)")
+    print("                           <format> can be:")
+    print("                                  text     Selector and title of each page")
+    print("                                  gopher   Gopher menu (for a type 7 selector)")
+    print("                                  gemini   Gemini response (asks for the words")
+    print("                                           when there are none)")
+    print("   -n, --limit   <num>     Max number of pages listed (default 50)")
+    print("   -H, --host    <host>    Host of the gopher menu (default to $SERVER_NAME)")
+    print("   -P, --port    <num>     Port of the gopher menu (default to $SERVER_PORT or 70)")
+    print("   -h, --help              Prints this help")
+    print("\nThe pages must have all the words, and a word that ends with * matches the")
+    print("words that start with it. Without words, they are taken from $SEARCHREQUEST")
+    print("or $QUERY_STRING (as set by gopher and gemini servers for CGI programs)")
+    sys.exit(2)
+
+
+def main(argv):
+    arIndex = os.environ.get('GGSEARCH_INDEX', "search.idx")
+    arLimit = 50
+    arHost = os.environ.get('SERVER_NAME', "localhost")
+    arPort = os.environ.get('SERVER_PORT', "70")
+    protocol = os.environ.get('SERVER_PROTOCOL', "").upper()
+    arFormat = "gemini" if protocol.startswith("GEMINI") else "gopher" \
+            if protocol.startswith(("GOPHER", "RFC1436")) else "text"
+
+    try:
+        opts, args = getopt.getopt(argv,"hi:f:n:H:P:",
+                ["help","index=","format=","limit=","host=","port="])
+    except getopt.GetoptError as e:
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        arguments()
+
+    try:
+        for opt, arg in opts:
+            if opt in ("-h","--help"):
+                arguments()
+            elif opt in ("-i", "--index"):
+                arIndex = arg
+            elif opt in ("-f", "--format"):
+                arFormat = arg
+            elif opt in ("-n", "--limit"):
+                arLimit = int(arg)
+            elif opt in ("-H", "--host"):
+                arHost = arg
+            elif opt in ("-P", "--port"):
+                arPort = str(int(arg))
+    except ValueError as e:
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        arguments()
+    if not (arFormat in ("text", "gopher", "gemini")):
+        print("ERROR: Invalid format ", arFormat, sep="", file = sys.stderr)
+        arguments()
+
+    query = ' '.join(args) or os.environ.get('SEARCHREQUEST') or \
+            urllib.parse.unquote_plus(os.environ.get('QUERY_STRING', ""))
+    if arFormat == "gemini" and not query.strip():
+        sys.stdout.write("10 Search words\r\n")
+        return
+    if not query.strip() and arFormat == "text":
+        arguments()
+
+    start = time.perf_counter()
+    try:
+        with Search_index(arIndex) as index:
+            total, results = index.search(query, arLimit)
+    except (OSError, ValueError) as e:
+        if arFormat == "gemini":
+            sys.stdout.write("42 Search is not available\r\n")
+        elif arFormat == "gopher":
+            sys.stdout.write("3Search is not available\t\terror.host\t1\r\n.\r\n")
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        sys.exit(1)
+    if arFormat == "gemini":
+        sys.stdout.write("20 text/gemini\r\n" + gemini_results(query, total, results))
+    elif arFormat == "gopher":
+        sys.stdout.write(gopher_results(query, total, results, arHost, arPort))
+    else:
+        print(total, "pages found in", round((time.perf_counter() - start) * 1000, 3), "ms")
+        for selector, title in results:
+            print(selector, " ", title)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,454 @@
+#!/usr/bin/python3 -u
+
+""" Golden outputs of Hugo 2 Gopher and Gemini (golden.py)
+
+    Converts the pages of a corpus (as Hugo generates them with this theme)
+    with hugo2gg.py, compares each output and its warnings byte for byte with
+    the golden ones, and times each case against a stored baseline. So a change
+    to the conversion (e.g. an optimization) can be checked before it is used:
+    save the baseline times before the change, and compare after it.
+
+    The golden outputs are the ones of an earlier hugo2gg.py (see --script),
+    and each case lists the differences of this version that are intended.
+
+    Copyright (C) 2021 Mike Marin -- All Rights Reserved
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3 of the License.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    You can contact me at mmarin <at> acm <dot> org
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import timeit
+import time
+import getopt
+import difflib
+import tempfile
+import contextlib
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import hugo2gg
+
+## The corpus folder has:
+##    cases.json     list of the cases, each one with its name, its page (in the
+##                   pages folder, .gophermap.txt or .gmi), and optionally the
+##                   options of the conversion (fields of hugo2gg.Options, e.g.
+##                   {"textAlign": "random", "textSeed": "golden"}), a map file,
+##                   and a base (as --base and --Base). A batch case has the
+##                   pages to convert and a list of sites, each one with its long
+##                   flags (e.g. {"map": "golden.map"}), see convert_batch.
+##                   The differences of the output with the golden one that are
+##                   intended are listed in the case (see apply_differences), and
+##                   a case that has no equivalent in the earlier version has its
+##                   reason in "new" (its golden is the output of this version)
+##    pages          the pages, as Hugo generates them with this theme
+##    golden         the golden output (.out) and warnings (.warn) of each case
+##    baseline.json  the time of each case, in seconds (see --baseline)
+
+corpusFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+diffLines = 40 # Max lines of the diff of a case that is different
+roundTime = 0.02 # Min seconds of each round of conversions that is timed (see best_time)
+defaults = None # Options of hugo2gg.py, before the ones of each case (see main)
+
+## To write the goldens with an earlier version of hugo2gg.py (see --script), it is
+## run through its command line in its own process. The options of the case (that
+## may have no flag) are set as globals of its module, and the random module is
+## seeded with the case (as the justification of earlier versions was random)
+scriptRunner = """import sys, json, random, importlib.util
+spec = importlib.util.spec_from_file_location('hugo2gg', sys.argv[1])
+script = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(script)
+for name, value in json.loads(sys.argv[2]).items():
+    if not hasattr(script, name):
+        sys.exit('ERROR: no option ' + name + ' in ' + sys.argv[1])
+    setattr(script, name, value)
+random.seed(sys.argv[3])
+sys.argv = sys.argv[1:2] + sys.argv[4:]
+script.main(sys.argv[1:])
+"""
+
+
+def case_options(case, corpus):
+    # Options of a case: the defaults of hugo2gg.py with the ones of the case
+    options = dict(case.get('options', {}))
+    if 'map' in case:
+        labels, replace, types = hugo2gg.read_map_file(os.path.join(corpus, case['map']))
+        options.update(mapLinkLabels = labels, mapReplace = replace, mapItemTypes = types)
+    return defaults._replace(**options)
+
+
+def clear_caches():
+    # So each conversion starts from scratch (see the memoized lines of hugo2gg.py)
+    hugo2gg.clean_line.cache_clear()
+    hugo2gg.clean_markdown.cache_clear()
+    hugo2gg.textLines.clear()
+
+
+def convert_case(case, page):
+    if case['page'].endswith('.gmi'):
+        return hugo2gg.convert_gemini_text(page, None, case.get('base', ''), case['name'])
+    return hugo2gg.convert_gopher_text(page, None, case.get('base', ''), case['name'])
+
+
+def convert(case, page):
+    # Output and warnings of the conversion of a case (with its options already set)
+    err = io.StringIO()
+    clear_caches()
+    with contextlib.redirect_stderr(err):
+        out = convert_case(case, page)
+    return out or '', err.getvalue()
+
+
+def best_time(case, page, repeat):
+    # Best time (in seconds) of a conversion of a case. As timeit does, the
+    # conversions are timed in rounds (of at least roundTime seconds) without
+    # garbage collections, and the best of repeat rounds is kept
+    def run():
+        clear_caches()
+        convert_case(case, page)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+        timer = timeit.Timer(run)
+        number = 1
+        while timer.timeit(number) < roundTime:
+            number *= 2
+        return min(timer.repeat(repeat, number)) / number
+
+
+def site_flags(site, corpus):
+    # Long flags of a site of a batch case (as the sites of a --batch manifest)
+    argv = []
+    for flag, value in site.items():
+        if flag == 'map':
+            value = os.path.abspath(os.path.join(corpus, value))
+        argv += ['--' + flag] if value is True else ['--' + flag, str(value)]
+    return argv
+
+
+def page_files(page):
+    # Files of a page in a site (relative to it): as Hugo generates it, and converted
+    name = os.path.basename(page)
+    if name.endswith('.gmi'):
+        return 'gemini/posts/%s/index.gmi' % name[:-4], 'gemini/posts/%s.gmi' % name[:-4]
+    folder = 'gopher/posts/' + name.split('.')[0]
+    return folder + '/gophermap.txt', folder + '/gophermap'
+
+
+def site_tree(path, pages, corpus):
+    # A site with the pages of a case (as Hugo generates them), under posts
+    for page in pages:
+        name = os.path.join(path, page_files(page)[0])
+        os.makedirs(os.path.dirname(name), exist_ok = True)
+        with open(os.path.join(corpus, 'pages', page), 'rb') as src, open(name, 'wb') as dst:
+            dst.write(src.read())
+
+
+def site_output(path):
+    # The converted files of a site, each one after its name
+    out = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            out.append('=> ' + os.path.relpath(os.path.join(root, name), path).replace(os.sep, '/') + '\n')
+            out.append(read_text(os.path.join(root, name)))
+    return ''.join(out)
+
+
+def run_hugo2gg(argv, folder, script = None, options = {}, seed = ''):
+    # Run hugo2gg.py (or script, see scriptRunner) in its own process (so each run
+    # starts from scratch), in folder, and return its errors and warnings.
+    # The sites are given relative to it, as hugo2gg.py cleans the names of the
+    # gopher and gemini folders (and a temporary folder may have an underscore)
+    if script:
+        command = [sys.executable, '-c', scriptRunner, os.path.abspath(script), json.dumps(options), seed]
+    else:
+        command = [sys.executable, os.path.abspath(hugo2gg.__file__)]
+    run = subprocess.run(command + ['-n'] + argv, cwd = folder, stdout = subprocess.DEVNULL,
+            stderr = subprocess.PIPE, encoding = 'utf-8')
+    if script and run.returncode:
+        raise OSError(run.stderr.strip().splitlines()[-1] if run.stderr.strip() else script + " failed")
+    return run.stderr
+
+
+def script_convert(case, corpus, script):
+    # Output and warnings of the conversion of a case with script, in a site with
+    # its page. The warnings name the files of the site, so they are renamed as
+    # the case (as convert names the page)
+    with tempfile.TemporaryDirectory() as folder:
+        src, dst = ('site/' + name for name in page_files(case['page']))
+        site_tree(os.path.join(folder, 'site'), [case['page']], corpus)
+        isGemini = dst.endswith('.gmi')
+        argv = ['-t', 'gemini' if isGemini else 'gopher', '-p', 'site', '-g', 'site/gopher', '-G', 'site/gemini']
+        if 'map' in case:
+            argv += ['--map', os.path.abspath(os.path.join(corpus, case['map']))]
+        if 'base' in case:
+            argv += ['-B' if isGemini else '-b', case['base']]
+        warnings = run_hugo2gg(argv, folder, script, case.get('options', {}), case['name'])
+        out = read_text(os.path.join(folder, dst))
+    return out or '', warnings.replace(src, case['name']).replace(dst, case['name'])
+
+
+def convert_batch(case, corpus, script = None):
+    # Output of the sites of a batch case converted with --batch (in one process, so
+    # they share the memoized lines), and of each site converted in its own run.
+    # They must be the same. With script, only the runs of each site with it
+    with tempfile.TemporaryDirectory() as folder:
+        sites = []
+        singles = []
+        for number, site in enumerate(case['batch']):
+            name = 'site%d' % number
+            single = 'single/' + name
+            site_tree(os.path.join(folder, single), case['pages'], corpus)
+            run_hugo2gg(['-t', 'all', '-p', single, '-g', single + '/gopher', '-G', single + '/gemini']
+                    + site_flags(site, corpus), folder, script, seed = case['name'] + name)
+            singles.append('== ' + name + '\n' + site_output(os.path.join(folder, single)))
+            if script:
+                continue
+            path = 'batch/' + name
+            site_tree(os.path.join(folder, path), case['pages'], corpus)
+            sites.append(dict(site, name = name, path = path,
+                    map = os.path.abspath(os.path.join(corpus, site['map'])) if 'map' in site else None))
+        with open(os.path.join(folder, 'batch.json'), 'wt') as fl:
+            json.dump(sites, fl)
+        if script:
+            return ''.join(singles), None
+        run_hugo2gg(['-t', 'all', '--batch', 'batch.json'], folder)
+        batch = ['== ' + site['name'] + '\n' + site_output(os.path.join(folder, site['path']))
+                for site in sites]
+    return ''.join(batch), ''.join(singles)
+
+
+def difference_text(text, newline):
+    # Text of a difference, given as a string or as a list of lines
+    return newline.join(text) if isinstance(text, list) else text
+
+
+def apply_differences(case, expected, out):
+    # The golden output and the output of a case, with the differences of this version
+    # that are intended. Each difference has its reason in "why", and either:
+    #    "golden" and "output"    text of the golden output that is "output" in this
+    #                             version (its first one, and it must be there)
+    #    "pattern" and "replace"  regular expression (multiline) replaced in both
+    #                             outputs, e.g. to compare the words but not the blanks
+    # They are applied in order
+    for difference in case.get('differences', []):
+        if 'pattern' in difference:
+            pattern = re.compile(difference['pattern'], re.MULTILINE)
+            expected = pattern.sub(difference['replace'], expected)
+            out = pattern.sub(difference['replace'], out)
+            continue
+        newline = '\r\n' if '\r\n' in expected else '\n' ## The gophermaps end their lines with CR LF
+        golden = difference_text(difference['golden'], newline)
+        if not golden in expected:
+            raise ValueError("not in the golden output, the difference: " + difference['why'])
+        expected = expected.replace(golden, difference_text(difference['output'], newline), 1)
+    return expected, out
+
+
+def read_text(name):
+    try:
+        with open(name, 'rt', encoding = 'utf-8', newline = '') as fl:
+            return fl.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_text(name, text):
+    if not text:
+        if os.path.exists(name):
+            os.remove(name)
+        return
+    with open(name, 'wt', encoding = 'utf-8', newline = '') as fl:
+        fl.write(text)
+
+
+def show_diff(expected, actual, name):
+    lines = list(difflib.unified_diff((expected or '').splitlines(True), actual.splitlines(True),
+            'golden/' + name, 'output/' + name))
+    for line in lines[:diffLines]:
+        sys.stdout.write('        ' + line + ('' if line.endswith('\n') else '\n'))
+    if len(lines) > diffLines:
+        print('        ...', len(lines) - diffLines, 'more lines')
+
+
+def arguments() :
+    print("Usage:\n ",os.path.basename(sys.argv[0])," [flags]\n\nFlags:")
+    print("   -c, --corpus  <path>    Folder of the corpus (default to corpus, next to this script)")
+    print("   -k, --case    <text>    Only the cases with <text> in their name")
+    print("   -r, --repeat  <num>     Rounds of conversions of each case to time, the best")
+    print("                           is kept (default 7)")
+    print("   -T, --tolerance <pct>   Slowdown over the baseline that is a regression (default 25)")
+    print("   -u, --update            Write the outputs and warnings of the new cases as the")
+    print("                           golden ones, and with --script the ones of all the cases")
+    print("   -s, --script  <file>    With --update, the golden outputs are converted with <file>,")
+    print("                           an earlier hugo2gg.py (e.g. git show efd720f:src/hugo2gg.py)")
+    print("   -b, --baseline          Write the times as the baseline")
+    print("   -o, --output  <file>    Append the results as a json line to <file>")
+    print("   -h, --help              Prints this help")
+    print("\nIt exits with 1 when an output is different, or a case is slower than the baseline")
+    sys.exit(2)
+
+
+def main(argv):
+    global defaults
+    arCorpus = corpusFolder
+    arCase = ""
+    arRepeat = 7
+    arTolerance = 25.0
+    arUpdate = False
+    arBaseline = False
+    arOutput = ""
+    arScript = ""
+
+    try:
+        opts, args = getopt.getopt(argv,"hc:k:r:T:us:bo:",
+                ["help","corpus=","case=","repeat=","tolerance=","update","script=","baseline","output="])
+    except getopt.GetoptError as e:
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        arguments()
+
+    try:
+        for opt, arg in opts:
+            if opt in ("-h","--help"):
+                arguments()
+            elif opt in ("-c", "--corpus"):
+                arCorpus = arg
+            elif opt in ("-k", "--case"):
+                arCase = arg
+            elif opt in ("-r", "--repeat"):
+                arRepeat = max(int(arg), 1)
+            elif opt in ("-T", "--tolerance"):
+                arTolerance = float(arg)
+            elif opt in ("-u", "--update"):
+                arUpdate = True
+            elif opt in ("-s", "--script"):
+                arScript = arg
+            elif opt in ("-b", "--baseline"):
+                arBaseline = True
+            elif opt in ("-o", "--output"):
+                arOutput = arg
+    except ValueError as e:
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        arguments()
+
+    try:
+        with open(os.path.join(arCorpus, "cases.json"), 'rt') as fl:
+            cases = [case for case in json.load(fl) if arCase in case['name']]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("ERROR: ", e, " while reading the cases of ", arCorpus, sep="", file = sys.stderr)
+        sys.exit(2)
+    baselineName = os.path.join(arCorpus, "baseline.json")
+    baseline = json.loads(read_text(baselineName) or '{}')
+    os.makedirs(os.path.join(arCorpus, "golden"), exist_ok = True)
+
+    hugo2gg.set_options(hugo2gg.get_options()) ## As hugo2gg.py does once the options are known
+    defaults = hugo2gg.get_options()
+    print("%-32s %-10s %10s %10s %7s" % ('Case', 'Output', 'Time (ms)', 'Baseline', 'Ratio'))
+    results = {}
+    failed = 0
+    for case in cases:
+        name = case['name']
+        single = None
+        seconds = None
+        golden = None
+        try:
+            if arUpdate and arScript and not 'new' in case:
+                if 'batch' in case:
+                    golden = convert_batch(case, arCorpus, arScript)[0], ''
+                else:
+                    golden = script_convert(case, arCorpus, arScript)
+            if 'batch' in case:
+                out, single = convert_batch(case, arCorpus)
+                warnings = ''
+            else:
+                options = case_options(case, arCorpus)
+                page = read_text(os.path.join(arCorpus, "pages", case['page']))
+                if page is None:
+                    raise OSError("no page " + case['page'])
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            print("%-32s ERROR: %s" % (name, e))
+            results[name] = {'output': 'error'}
+            failed += 1
+            continue
+        if single is None:
+            hugo2gg.set_options(options)
+            out, warnings = convert(case, page)
+            seconds = best_time(case, page, arRepeat)
+            hugo2gg.set_options(defaults)
+
+        outName = os.path.join(arCorpus, "golden", name + ".out")
+        warnName = os.path.join(arCorpus, "golden", name + ".warn")
+        expected = read_text(outName)
+        expectedWarnings = read_text(warnName) or ''
+        compared = out
+        if arUpdate and 'new' in case:
+            golden = out, warnings
+        if golden is not None:
+            status = 'new' if expected is None else 'same' if (expected, expectedWarnings) == golden else 'updated'
+            write_text(outName, golden[0])
+            write_text(warnName, golden[1])
+        elif expected is None:
+            status = 'missing'
+        else:
+            try:
+                expected, compared = apply_differences(case, expected, out)
+                status = 'same' if (expected, expectedWarnings) == (compared, warnings) else 'DIFFERENT'
+            except (ValueError, KeyError, re.error) as e:
+                print("%-32s ERROR: %s" % (name, e))
+                status = 'DIFFERENT'
+        if single is not None and single != out: ## The batch is not as the single runs
+            status = 'DIFFERENT'
+        slower = seconds is not None and name in baseline and seconds > baseline[name] * (1 + arTolerance / 100)
+        ratio = seconds / baseline[name] if seconds is not None and baseline.get(name) else None
+        print("%-32s %-10s %10s %10s %7s%s" % (name, status, '-' if seconds is None else "%.3f" % (seconds * 1000),
+            "%.3f" % (baseline[name] * 1000) if name in baseline else '-',
+            "%.2f" % ratio if ratio else '-', '  SLOWER' if slower and not arBaseline else ''))
+        if status in ('DIFFERENT', 'missing') or (slower and not arBaseline):
+            failed += 1
+        if status in ('DIFFERENT', 'missing'):
+            if single is not None and single != out:
+                show_diff(single, out, name + ".single")
+            elif expected != compared:
+                show_diff(expected, compared, name + ".out")
+            if expectedWarnings != warnings:
+                show_diff(expectedWarnings, warnings, name + ".warn")
+        results[name] = {'output': status, 'baseline': baseline.get(name)}
+        if seconds is not None:
+            results[name]['seconds'] = seconds
+
+    total = sum(result.get('seconds', 0) for result in results.values())
+    totalBaseline = sum(baseline.get(name, 0) for name, result in results.items() if 'seconds' in result)
+    print("%-32s %-10s %10.3f %10s %7s" % ('Total', '', total * 1000,
+        "%.3f" % (totalBaseline * 1000) if totalBaseline else '-',
+        "%.2f" % (total / totalBaseline) if totalBaseline else '-'))
+    if arBaseline:
+        baseline.update({name: result['seconds'] for name, result in results.items() if 'seconds' in result})
+        with open(baselineName, 'wt') as fl:
+            json.dump(baseline, fl, indent = 1, sort_keys = True)
+            fl.write('\n')
+        print("Baseline written to", baselineName)
+    if arOutput:
+        with open(arOutput, 'a') as fl:
+            fl.write(json.dumps({'corpus': arCorpus, 'repeat': arRepeat, 'cases': results}) + '\n')
+    print(len(results), "cases,", failed, "failed")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -27,31 +27,140 @@ import re
 import io
 import sys
 import html
+import errno
+import json
+import glob
 import shutil
+import hashlib
 import getopt
+import pstats
+import cProfile
+import tracemalloc
+import time
+import functools
 import random
 import urllib
+import ast
 import inspect
+import posixpath
 import textwrap
+import threading
 import datetime
 import mimetypes
+import contextlib
+import multiprocessing.util
+import ssl
+import asyncio
 import subprocess
+import collections
+import concurrent.futures
+try:
+    import ggsearch # Only needed for the search index (see --index), next to this script
+except ImportError:
+    ggsearch = None
+try:
+    import fcntl # Only needed for reflinks (see clone_file)
+except ImportError:
+    fcntl = None
 
 ## Global variables
 verbose = False
 keepTmpFiles = False
 fullGopherLine = False
 gopherLineLength = 70
+textAlign = "justify"
+textSeed = "" # Seed of the random alignment, with each line (see justify_line)
 maxEmptyLines = 1
 mapLinkLabels = {}
 mapReplace = {}
+mapReplacePattern = None # Compiled from mapReplace (see compile_map_replace)
+mapPatterns = {} # Items of mapReplace -> its compiled pattern (shared by the sites of a batch)
+mapLabelItems = frozenset() # Items of mapLinkLabels of the memoized lines (see compile_map_replace)
+mapFiles = {}    # Map file name -> (mtime_ns, mapLinkLabels, mapReplace, mapItemTypes) (see read_map_file)
+mapItemTypes = {} # Gopher item types by file extension, from the map file
+cloneMethod = "copy"
+cloneThreads = 8 # Threads cloning the static files (see traverse_site)
+dedupeAssets = False
+searchIndex = False
+searchIndexName = "search.idx" # In the gopher and gemini folders (see update_search_index)
+cacheFolder = ""
+cacheSeed = ""
+watchInterval = 1.0 # Seconds between the scans of the site in watch mode
+serveHost = "localhost" # Preview servers (see --serve)
+serveGopherPort = 7070
+serveGeminiPort = 1965
+serveTimeout = 10 # Seconds to wait for a request
+serveCertificate = "hugo2gg-serve" # Name (without extension) of the gemini certificate and key
+searchSelector = "/search" # Search of the preview servers (when there is a search index)
+searchLimit = 50 # Max number of pages listed by a search
+statsFile = ""
+statsSlowest = 20 # Number of slowest pages in the stats
+profileMode = "" # "cpu" or "mem" (see --profile)
+profileName = "hugo2gg-profile" # Name (without extension) of the profile files
+
+## Snapshot of the global variables above, shipped to the conversion workers
+Options = collections.namedtuple('Options', ['verbose', 'keepTmpFiles',
+    'fullGopherLine', 'gopherLineLength', 'textAlign', 'maxEmptyLines', 'mapLinkLabels', 'mapReplace',
+    'mapItemTypes', 'cacheFolder', 'cacheSeed', 'profileMode', 'searchIndex', 'textSeed'])
+
+## Build cache bookkeeping (only used by the main process)
+buildManifest = {'gopher': {}, 'gemini': {}}
+reusedPages = 0
+
+## Run metrics (see --stats). The workers return theirs with each page (see convert_page)
+runCounters = collections.Counter() # Lines read, links extracted, warnings, etc.
+countersLock = threading.Lock() # For the counters updated by the clone threads (see traverse_site)
+warnCount = 0 # Warnings given (see text_lines)
+pageTimes = []  # (wall, cpu, kind, page) of each converted page
+phaseTimes = {} # phase -> [wall, cpu] (of the main process)
+
+## Internal links of each converted page (see check_links). The workers return them with each page
+siteLinks = {}  # (kind, page) -> [selector or path]
+
+## Title and words of each converted page (see update_search_index). The workers return them with each page
+siteTerms = {}  # (kind, page) -> (title, [word])
+searchPages = {} # index file name -> {selector: (title, words)} of the last index written
+
+## Profiling (see --profile). As the run metrics, the workers return theirs with each page
+## (but the memory sites, that each worker writes at its exit, see worker_memory)
+cpuProfiles = [] # Raw cProfile stats of the main process and of each page in the workers
+memSites = collections.Counter() # (function, line) -> bytes allocated and not freed
+memPeaks = {}    # phase -> peak of traced memory
+memSnapshot = None # Snapshot of a worker at its first page (see worker_memory)
+
+
+def get_options():
+    return Options(verbose, keepTmpFiles, fullGopherLine, gopherLineLength, textAlign,
+            maxEmptyLines, mapLinkLabels, mapReplace, mapItemTypes, cacheFolder, cacheSeed,
+            profileMode, searchIndex, textSeed)
+
+
+def set_options(options):
+    # Used as the initializer of the worker processes (see convert_page)
+    global verbose, keepTmpFiles, fullGopherLine, gopherLineLength, textAlign
+    global maxEmptyLines, mapLinkLabels, mapReplace, mapItemTypes, cacheFolder, cacheSeed
+    global profileMode, searchIndex, textSeed
+    (verbose, keepTmpFiles, fullGopherLine, gopherLineLength, textAlign, maxEmptyLines,
+            mapLinkLabels, mapReplace, mapItemTypes, cacheFolder, cacheSeed,
+            profileMode, searchIndex, textSeed) = options
+    compile_map_replace()
+    build_item_types()
 
 def vbprint(*args, **kwargs):
     if verbose:
         print(*args, **kwargs)
 
 
+def category(args):
+    # Category of a warning or an error message (for --stats)
+    if args and isinstance(args[0], BaseException):
+        return type(args[0]).__name__
+    text = str(args[0]) if args else ''
+    return re.split(r"[(\['\":]", text, 1)[0].strip()
+
+
 def error(*args, **kwargs):
+    runCounters['error: ' + category(args)] += 1
     if verbose:
         print("ERROR [",os.path.basename(sys.argv[0]),":",
                 inspect.currentframe().f_back.f_lineno,"]: ",
@@ -61,6 +170,9 @@ def error(*args, **kwargs):
 
 
 def warn(*args, **kwargs):
+    global warnCount
+    warnCount += 1
+    runCounters['warning: ' + category(args)] += 1
     if verbose:
         print("WARNING [",os.path.basename(sys.argv[0]),":",
                 inspect.currentframe().f_back.f_lineno,"]: ",
@@ -83,6 +195,7 @@ class Markdown_reader:
     re_head3  = re.compile(r'^\s*---+')         ## Headings
     re_quote  = re.compile(r'^\s*>[ \t\v\f]*')  ## Blockquotes
     re_llink  = re.compile(r'^i?\s*!?\[[^\]]*\]\([^\)]*\)\s*$|^i?\s*<[^<]+[@:][^<]+>\s*$') ## One line link
+    re_lstart = re.compile(r'\s*(i\s*)?[!\[<]|\s*i\s*$')  ## May start a one line link
 
     ## OK in the first line, but not in the second line:
     re_ulist  = re.compile(r'^\s*[-\*\+][ \t\v\f]+') ## Unordered lists
@@ -94,10 +207,21 @@ class Markdown_reader:
     re_break1 = re.compile(r'  $')        ## Line break
     re_break2 = re.compile(r'<br>[ \t\v\f]*$')   ## Line break
 
-    def __init__(this, src, isGopher):
+    def __init__(this, src, isGopher, text = None):
+        ## When text is given (a string or an iterable of lines) it is read
+        ## instead of the file src (which then only names the page)
         this.isValid = True
+        this.src = src
         try:
-            this.flSrc = open(src, 'rt')
+            ## The whole file is read at once, and then split in lines (in C)
+            if text is None:
+                with open(src, 'rt') as flSrc:
+                    text = flSrc.read()
+            elif not isinstance(text, str):
+                text = ''.join(l if l.endswith('\n') else l + '\n' for l in text)
+            lines = io.StringIO(text).readlines()
+            runCounters['lines read'] += len(lines)
+            this.lines = iter(lines)
             this.count = 0
             this.line = ''
             this.nextline = ''
@@ -108,15 +232,14 @@ class Markdown_reader:
             this.isValid = False
 
     def destroy(this): ## avoid using __del__
-        if not this.isValid:
-            return
-        try:
-            this.flSrc.close()
-        except OSError as e:
-            error(e, " while closing file", src)
+        this.lines = iter(())
 
-    def good(this):
-        ## Answer the question: is it OK to combine this.line with this.nextline?
+    def readline(this):
+        return next(this.lines, '')
+
+    def good(this, parts):
+        ## Answer the question: is it OK to combine the line with this.nextline?
+        ## The line is given by its parts (see get_line), which are only joined if needed
 
         def good_both(line):
             ## Not OK in any of two consecutive lines:
@@ -149,71 +272,108 @@ class Markdown_reader:
             else:
                 return True
 
-        assert (this.line + this.rest) and this.nextline
-        if this.isGopher and this.line and (this.line[0] == 'i') and (this.nextline[0] == 'i'):
-            line1 = this.line[1:]
+        def good_merged(parts, skip):
+            ## A merged line starts with the first line (already checked with good_both), and
+            ## the separator blank of each merge breaks any of the start anchored elements.
+            ## So, only the one line link needs the whole line (if it starts like one)
+            if this.re_lstart.match(parts[0], skip):
+                if this.re_llink.search(''.join(parts)[skip:]):
+                    return False
+            ## and the line breaks only need the tail of the line (up to the last part with text)
+            tail = []
+            for part in reversed(parts):
+                tail.append(part)
+                if part.strip():
+                    break
+            return good_first(''.join(reversed(tail)))
+
+        assert (parts[0] + this.rest) and this.nextline
+        skip = 0
+        if this.isGopher and parts[0] and (parts[0][0] == 'i') and (this.nextline[0] == 'i'):
+            skip = 1
             line2 = this.nextline[1:]
         elif this.isGopher: ## This is a non-text gopher line (meaning a link line) and shoul not be merged
             return False
         else:
-            line1 = this.line
             line2 = this.nextline
-        return (good_both(line1)  and good_both(line2) and 
-                good_first(line1) and good_second(line2))
+        if not (good_both(line2) and good_second(line2)):
+            return False
+        if len(parts) > 1:
+            return good_merged(parts, skip)
+        line1 = parts[0][skip:]
+        return good_both(line1) and good_first(line1)
 
     def get_line(this, isFenced):
         # isFenced means that it inside a code block that start with three back tildes (``` code ```)
         # and so it should be considered literal
         if not this.isValid:
             return ''
-        try:
-            while True:
-                if this.nextline:
-                    this.line = this.nextline
-                    this.nextline = ''
-                else:
-                    this.line = this.flSrc.readline()
-                if not this.line:
+
+        def rstrip(parts, chars):
+            while parts:
+                part = parts[-1].rstrip(chars)
+                if part:
+                    parts[-1] = part
+                    return
+                parts.pop()
+
+        def lstrip(parts, chars):
+            while parts:
+                part = parts[0].lstrip(chars)
+                if part:
+                    parts[0] = part
+                    return
+                parts.pop(0)
+
+        # Soft wrapped lines are merged into a single line. The merged line is kept as a list
+        # of parts (joined once at the end), where only the last part can have a tab
+        parts = [this.nextline if this.nextline else this.readline()]
+        this.nextline = ''
+        while True:
+            if not parts[-1]:
+                this.rest = ''
+                break
+            this.count += 1
+            assert not this.nextline
+            this.nextline = this.readline()
+            if this.isGopher:
+                if parts[0][0] != 'i':
                     this.rest = ''
                     break
-                this.count += 1
-                assert not this.nextline
-                this.nextline = this.flSrc.readline()
-                if this.isGopher:
-                    if this.line[0] != 'i':
-                        this.rest = ''
-                        break
-                    ln = this.line.split('\t',1)
-                    this.line = ln[0]
-                    this.rest = '' if len(ln) <= 1 else '\t' + ln[1].rstrip('\r\n')
-                if (not isFenced) and (this.line + this.rest) and this.nextline and this.good():
-                    this.line = this.line.rstrip('\r\n')
-                    this.nextline = this.nextline if not this.isGopher else this.nextline[1:]
-                    if this.re_quote.search(this.nextline):  ## Blockquotes
-                        this.nextline = this.nextline.replace('>','',2)
-                    this.nextline = this.line.strip('\t ') + ' ' + this.nextline
-                    continue
-                else:
-                    break
-            if (not isFenced) and this.re_break2.search(this.line):  ## Line break
-                this.line = this.line.replace('<br>','')
-
-            # Ready to return a line, but need to clean it up first if it is not fenced
-            # Note that lines starting with four blanks or a tab are considered fenced
-            rLine = this.line + this.rest
-            if not isFenced:
-                if len(rLine) > 4:
-                    if (rLine[0:4] == '    ') or (rLine[0:1] == '\t'):
-                        isFenced = True
-                    elif this.isGopher and ((rLine[0:5] == 'i    ') or (rLine[0:2] == 'i\t')):
-                        isFenced = True
-
-            if isFenced:
-                return rLine
+                ln = parts[-1].split('\t',1)
+                parts[-1] = ln[0]
+                this.rest = '' if len(ln) <= 1 else '\t' + ln[1].rstrip('\r\n')
+            if (not isFenced) and (parts[0] + this.rest) and this.nextline and this.good(parts):
+                rstrip(parts, '\r\n')
+                this.nextline = this.nextline if not this.isGopher else this.nextline[1:]
+                if this.re_quote.search(this.nextline):  ## Blockquotes
+                    this.nextline = this.nextline.replace('>','',2)
+                lstrip(parts, '\t ')
+                rstrip(parts, '\t ')
+                parts.append(' ' + this.nextline)
+                runCounters['lines merged'] += 1
+                this.nextline = ''
+                continue
             else:
-                return html.unescape(rLine)
-        except OSError as e:
-            error(e, " while reading file", src)
+                break
+        this.line = ''.join(parts)
+        if (not isFenced) and this.re_break2.search(this.line):  ## Line break
+            this.line = this.line.replace('<br>','')
+
+        # Ready to return a line, but need to clean it up first if it is not fenced
+        # Note that lines starting with four blanks or a tab are considered fenced
+        rLine = this.line + this.rest
+        if not isFenced:
+            if len(rLine) > 4:
+                if (rLine[0:4] == '    ') or (rLine[0:1] == '\t'):
+                    isFenced = True
+                elif this.isGopher and ((rLine[0:5] == 'i    ') or (rLine[0:2] == 'i\t')):
+                    isFenced = True
+
+        if isFenced or not '&' in rLine:
+            return rLine
+        else:
+            return html.unescape(rLine)
 
     def get_count(this):
         return this.count
@@ -221,23 +381,139 @@ class Markdown_reader:
 ### End Markdown_reader
 
 
+class Site_index:
+    #### In memory index of the files of the site (the Hugo output)
+    ## Built with a single os.scandir scan of the site folder, so the different
+    ## phases don't need to walk the disk again. Each folder is classified as
+    ## 'gopher', 'gemini' (under arGopher or arGemini), or 'site' (anything else).
+    ## The index is kept up to date (add and remove) while the phases clone,
+    ## convert, or delete files.
+
+    def __init__(this, arPath, arGopher, arGemini, files = None):
+        this.arPath = arPath
+        this.arGopher = arGopher
+        this.arGemini = arGemini
+        this.folders = {} # rootDir -> (kind, subdirs, {filename: None})
+        this.count = 0
+        this.partial = files is not None
+        if this.partial: ## Only the given files (see watch_site)
+            for name in files:
+                this.add(name)
+            this.count = len(files)
+            return
+        folders = [arPath]
+        while folders:
+            rootDir = folders.pop()
+            subdirs = []
+            children = []
+            filenames = {}
+            try:
+                with os.scandir(rootDir) as entries:
+                    for entry in entries:
+                        try:
+                            isDir = entry.is_dir()
+                        except OSError:
+                            isDir = False
+                        if isDir:
+                            subdirs.append(entry.name)
+                            if not entry.is_symlink():
+                                children.append(entry.path)
+                        else:
+                            filenames[entry.name] = None
+            except OSError as e:
+                error(e, " while scanning ", rootDir)
+            this.count += len(filenames)
+            this.folders[rootDir] = (this.kind(rootDir), subdirs, filenames)
+            folders.extend(reversed(children)) # Same (top-down) order as os.walk
+        vbprint("INDEX:", len(this.folders), "folders and", this.count, "files")
+
+    def kind(this, rootDir):
+        if rootDir[0:len(this.arGopher)] == this.arGopher:
+            return 'gopher'
+        if rootDir[0:len(this.arGemini)] == this.arGemini:
+            return 'gemini'
+        return 'site'
+
+    def walk(this, top, kind = None):
+        # Like os.walk(top), but from the index, and optionally only the folders of one kind.
+        # It is safe to add or remove files while walking (lists are copies)
+        prefix = os.path.join(top, '')
+        for rootDir in list(this.folders):
+            if rootDir == top or rootDir.startswith(prefix):
+                folderKind, subdirs, filenames = this.folders[rootDir]
+                if kind and folderKind != kind:
+                    continue
+                yield rootDir, subdirs, list(filenames)
+
+    def has_folder(this, path):
+        return path in this.folders
+
+    def files(this):
+        for rootDir, (kind, subdirs, filenames) in this.folders.items():
+            for filename in filenames:
+                yield os.path.join(rootDir, filename)
+
+    def add(this, name):
+        rootDir, filename = os.path.split(name)
+        if not rootDir in this.folders:
+            this.folders[rootDir] = (this.kind(rootDir), [], {})
+        this.folders[rootDir][2][filename] = None
+
+    def remove(this, name):
+        rootDir, filename = os.path.split(name)
+        if rootDir in this.folders:
+            this.folders[rootDir][2].pop(filename, None)
+
+    def move(this, src, dst):
+        # After src (a file or a whole folder) was renamed to dst.
+        # A folder is merged with dst when the index has both
+        prefix = os.path.join(src, '')
+        moved = [rootDir for rootDir in this.folders if rootDir == src or rootDir.startswith(prefix)]
+        if not moved:
+            rootDir, filename = os.path.split(src)
+            if rootDir in this.folders and filename in this.folders[rootDir][2]:
+                this.remove(src)
+                this.add(dst)
+            return
+        for rootDir in moved:
+            kind, subdirs, filenames = this.folders.pop(rootDir)
+            target = dst + rootDir[len(src):]
+            if target in this.folders:
+                this.folders[target][1].extend(name for name in subdirs
+                        if not name in this.folders[target][1])
+                this.folders[target][2].update(filenames)
+            else:
+                this.folders[target] = (this.kind(target), subdirs, filenames)
+        parent = this.folders.get(os.path.dirname(src))
+        if parent and os.path.basename(src) in parent[1]:
+            parent[1].remove(os.path.basename(src))
+        parent = this.folders.get(os.path.dirname(dst))
+        if parent and not os.path.basename(dst) in parent[1]:
+            parent[1].append(os.path.basename(dst))
+
+### End Site_index
+
+
 def delete_file(name, clean = True):
     if keepTmpFiles:
         return
     try:
-        path = os.path.dirname(name)
         os.remove(name)
-
         if clean:
-            while len(os.listdir(path)) == 0:
-                base = os.path.dirname(path)
-                os.rmdir(path)
-                path = base
+            remove_empty_folders(os.path.dirname(name))
 
     except OSError as e:
         warn(e, "deleting ",name)
 
 
+def remove_empty_folders(path):
+    # Remove path and its parents for as long as they are empty
+    while len(os.listdir(path)) == 0:
+        base = os.path.dirname(path)
+        os.rmdir(path)
+        path = base
+
+
 def clean_dir(folder):
     """Clean a directory or folder name by removing special characters
 
@@ -267,8 +543,13 @@ def clean_dir(folder):
     return rtrn
 
 
-def clone_file(src, dst):
-    """Copy the src file to the dst file treating them as binary files
+FICLONE = 0x40049409 # Linux ioctl to share the data blocks of two files (reflink)
+
+def clone_file(src, dst, method = "copy", folders = None):
+    """Clone the src file to the dst file treating them as binary files
+
+    A copy keeps the modification time of src, and it is skipped when dst
+    already has the same size and modification time (e.g. from the last build)
 
     Parameters
     ----------
@@ -276,22 +557,144 @@ def clone_file(src, dst):
         Source full file name
     dst : str
         Destination full file name
+    method : str
+        "copy" the data, "move" (rename) src, "hardlink" or "reflink" dst to src.
+        It falls back to copying when src and dst are in different file systems
+        (or when the file system does not support hard links or reflinks)
+    folders : set
+        Folders known to exist, to create each destination folder once
+        (see traverse_site)
 
     Returns
     -------
-    Nothing
+    bool
+        True when src was moved to dst
     """
 
-    vbprint("CLONE:",src,"->",dst)
+    vbprint("CLONE:",src,"->",dst, "" if method == "copy" else "(" + method + ")")
+    moved = False
     try:
         dstFolder = os.path.dirname(dst)
-        if not os.path.exists(dstFolder):
-            os.makedirs(dstFolder)
-
-        shutil.copyfile(src, dst)
+        if folders is None or not dstFolder in folders:
+            os.makedirs(dstFolder, exist_ok = True)
+            if folders is not None:
+                folders.add(dstFolder)
+
+        st = os.stat(src)
+        cloned = st.st_size
+        linked = False ## Moved or hardlinked, so no bytes are cloned
+        try:
+            if method == "move":
+                os.replace(src, dst)
+                moved = linked = True
+            elif method == "hardlink":
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.link(src, dst)
+                linked = True
+            elif method == "reflink":
+                if not fcntl:
+                    raise OSError(errno.EOPNOTSUPP, "reflinks are not supported")
+                if os.path.lexists(dst): ## Do not write through the other links (see --dedupe)
+                    os.remove(dst)
+                with open(src, 'rb') as flSrc, open(dst, 'wb') as flDst:
+                    fcntl.ioctl(flDst.fileno(), FICLONE, flSrc.fileno())
+            else:
+                cloned = copy_file(src, dst, st)
+        except OSError as e:
+            if not e.errno in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP,
+                    errno.EINVAL, errno.ENOTTY):
+                raise
+            vbprint("CLONE: falling back to copy (",e,")")
+            cloned = copy_file(src, dst, st)
+
+        with countersLock:
+            if linked:
+                runCounters['files linked'] += 1
+            elif cloned:
+                runCounters['bytes cloned'] += cloned
+            else:
+                runCounters['bytes skipped'] += st.st_size
 
     except OSError as e:
         error(e, " while processing files", src,"=>",dst)
+    return moved
+
+
+def copy_file(src, dst, st):
+    # Copy src (with stat st) to dst keeping its modification time, unless dst
+    # has already the same size and modification time. Returns the bytes copied
+    try:
+        dstSt = os.stat(dst)
+        if dstSt.st_size == st.st_size and dstSt.st_mtime_ns == st.st_mtime_ns:
+            vbprint("CLONE: unchanged", dst)
+            return 0
+        if dstSt.st_nlink > 1: ## Do not write through the other links (see --dedupe)
+            os.remove(dst)
+    except FileNotFoundError:
+        pass
+    shutil.copyfile(src, dst)
+    os.utime(dst, ns = (st.st_atime_ns, st.st_mtime_ns))
+    return st.st_size
+
+
+def clone_static(src, targets, folders = None):
+    # Clone src into each of the targets with the --clone method.
+    # Unless copying, src is moved to the first target, and the other
+    # targets are hardlinked, reflinked, or copied (for move) from it.
+    # Returns True when src was moved
+    method = "copy" if cloneMethod == "move" else cloneMethod
+    if cloneMethod == "copy" or keepTmpFiles:
+        for target in targets:
+            clone_file(src, target, method, folders)
+        return False
+    if not clone_file(src, targets[0], "move", folders):
+        for target in targets[1:]:
+            clone_file(src, target, method, folders)
+        return False
+    for target in targets[1:]:
+        clone_file(targets[0], target, method, folders)
+    return True
+
+
+def page_buffer():
+    # In memory text file for a converted page (encoded as open(dst, 'wt') would do)
+    return io.TextIOWrapper(io.BytesIO(), write_through = True)
+
+
+def write_page(dst, data):
+    """Write a converted page, only when its content changed
+
+    The page is written to a temporary file that replaces dst, so readers
+    (e.g. a running gopher server) never see a half written page. When dst
+    already has the same content it is not touched, so it keeps its mtime.
+
+    Parameters
+    ----------
+    dst : str
+        Destination full file name
+    data : bytes or page_buffer
+        Content of the page
+
+    Returns
+    -------
+    bool
+        True when dst was written
+    """
+
+    if not isinstance(data, bytes):
+        data = data.buffer.getvalue()
+    try:
+        with open(dst, 'rb') as fl:
+            if os.fstat(fl.fileno()).st_size == len(data) and fl.read() == data:
+                vbprint("UNCHANGED:", dst)
+                return False
+    except OSError:
+        pass ## Does not exist (or can not be read), so write it
+    with open(dst + "-new", 'wb') as fl:
+        fl.write(data)
+    os.replace(dst + "-new", dst)
+    return True
 
 
 def extract_arg(line):
@@ -343,89 +746,209 @@ def extract_arg(line):
     return arg
 
 
+def read_map_file(name):
+    # Labels of the links, text replacements, and gopher item types of a map
+    # file. Each file is read once (until it changes), as the sites of a batch
+    # may share it (see batch_sites)
+    mtime = os.stat(name).st_mtime_ns
+    if name in mapFiles and mapFiles[name][0] == mtime:
+        return mapFiles[name][1:]
+    mapLinkLabels = {}
+    mapReplace = {}
+    mapItemTypes = {}
+    with open(name) as map:
+        for line in map:
+            line = line.strip(' \t\n\r')
+            if not line or line[0] == '#':
+                continue
+            key, sep, label = line.partition(":=")
+            key = key.strip()
+            if sep == ":=" and key:
+                label = label.strip()
+                if label and label[0] == '"' and label[-1] == '"':
+                    label = label[1:-1]
+                if key and key[0] == '"' and key[-1] == '"':
+                    key = key[1:-1]
+                vbprint("Replace:",key,"with",label)
+                mapReplace[key] = label
+            if not sep:
+                key, sep, label = line.partition("=")
+                key = key.strip()
+                if sep == "=" and key:
+                    label = label.strip()
+                    if label and label[0] == '"' and label[-1] == '"':
+                        label = label[1:-1]
+                    if key[0] == '.' and len(label) == 1:
+                        vbprint("Item type:",key,"is",label)
+                        mapItemTypes[key.lower()] = label
+                    else:
+                        vbprint("Map:",key,"to",label)
+                        mapLinkLabels[key] = label
+    mapFiles[name] = (mtime, mapLinkLabels, mapReplace, mapItemTypes)
+    return mapLinkLabels, mapReplace, mapItemTypes
+
+
+def compile_map_replace():
+    # Compile all the keys of mapReplace into a single regular expression, so
+    # each line is scanned once regardless of the number of keys.
+    # The expression is built from a trie of the keys, where longer keys are
+    # tried first. So, at each position of the line the longest key wins.
+    # The pattern of each map is kept, and the memoized lines are only
+    # cleared when the map (its replacements or link labels) changes
+    # (e.g. between the sites of a batch)
+    global mapReplacePattern, mapLabelItems
+
+    def trie_pattern(node):
+        options = [re.escape(ch) + trie_pattern(child) for ch, child in node.items() if ch]
+        if not options:
+            return ''
+        pattern = options[0] if len(options) == 1 else '(?:' + '|'.join(options) + ')'
+        if '' in node: ## a key ends here, but longer keys are tried first
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    items = frozenset(mapReplace.items())
+    if not items in mapPatterns:
+        trie = {}
+        for key in mapReplace:
+            if not key:
+                continue
+            node = trie
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[''] = None
+        mapPatterns[items] = re.compile(trie_pattern(trie)) if trie else None
+    labels = frozenset(mapLinkLabels.items())
+    if mapPatterns[items] is not mapReplacePattern or labels != mapLabelItems:
+        mapReplacePattern = mapPatterns[items]
+        mapLabelItems = labels
+        clean_line.cache_clear()
+
+
 def replace_mapped_text(line):
     # will try to replace all text specified in the mapping file
-    if not mapReplace:
+    # (in a single pass, so replaced text is not replaced again)
+    if not mapReplacePattern:
         return line
-    for key, label in mapReplace.items():
-        line = line.replace(key,label)
-    return line
+    return mapReplacePattern.sub(lambda match: mapReplace[match.group()], line)
+
+re_html_tag  = re.compile(r'<\/\w*>|<.+?>')
+re_html_name = re.compile(r'\/?\w+')
+re_html_void = re.compile(r'<!--.*?-->|<(?:img|br|hr)\b[^>]*>|<\w[^<>]*/>', re.IGNORECASE)
 
 def clean_html_tags(line):
-    # Process html tags and either remove them or convert them to links
-    def process_html_tags(line,tags):
-        if len(tags) == 2:
-            all = line[line.find(tags[0]) : line.find(tags[1])+len(tags[1])]
-            txt = line[line.find(tags[0])+len(tags[0]):line.find(tags[1])]
-            if tags[1] == "</a>":
-                link = re.search(r'".*?"',tags[0]).group()
+    # Process html tags and either remove them or convert them to links.
+    # Comments, void tags (<img>, <br>, <hr>) and self-closing tags have no pair, so they
+    # are removed first. Then tags are paired in a single scan of the line using a stack:
+    # a closing tag is paired with the tag on the top of the stack when they have the same
+    # name, and the pair is replaced by the text between them (or by [text](uri) for <a href>).
+    # Note that are cases when not all the tags are in a line, and they are kept
+    # in other words only the matching pairs in the line are processed
+    if not '<' in line:
+        return line
+    line = re_html_void.sub('', line)
+    pieces = []  # output pieces (text and tags)
+    stack = []   # (name, index in pieces, tag) of the tags not yet paired
+    pos = 0
+    for match in re_html_tag.finditer(line):
+        pieces.append(line[pos:match.start()])
+        pos = match.end()
+        tag = match.group()
+        name = re_html_name.search(tag)
+        name = name.group() if name else ''
+        if name and name[0] == '/' and stack and stack[-1][0] == name[1:]:
+            _, index, openTag = stack.pop()
+            txt = ''.join(pieces[index + 1:])
+            del pieces[index:]
+            if name == '/a':
+                link = re.search(r'".*?"', openTag)
                 if link:
-                    txt = '[' + txt + '](' + link[1:-1] + ')' 
-            return line.replace(all,txt)
-        indexes = []
-        last_tag = ""
-        last_name = "."
-        last_index = -1
-        for i,t in enumerate(tags):
-            n = re.search(r'\/?\w+',t).group()
-            if n[0] == '/' and last_name == n[1:]:
-                nLine = process_html_tags(line,[last_tag,t])
-                return  process_html_tags(nLine,tags[:last_index] + tags[i+1:])
-            last_tag = t
-            last_name = n
-            last_index = i
-        # Note that are cases when not all the tags are in a line, and they are skip
-        # in other words if the number of tags are odd then we will only process the pairs in the line
+                    txt = '[' + txt + '](' + link.group()[1:-1] + ')'
+            pieces.append(txt)
+        else:
+            stack.append((name, len(pieces), tag))
+            pieces.append(tag)
+    if not stack and len(pieces) == 1 and pos == 0:
         return line
+    pieces.append(line[pos:])
+    return ''.join(pieces)
 
-    tags = re.findall(r'<\/\w*>|<.+?>',line) # Find all the html tags in the line
-    if tags:
-        return process_html_tags(line,tags)
-    return line
 
+re_shortcut = re.compile(r'{{% .*? %}}|{{< .*? >}}')
 
 def clean_hugo_shortcuts(line):
     # Hugo is not able to process shorcuts for text output (which is unfortunate)
     # So, we need to do thius hack in here
-    scs = re.findall(r'{{% .*? %}}|{{< .*? >}}',line)
-    for s in scs:
-        pieces = s.split()
+    def shortcut_link(match):
+        pieces = match.group().split()
         if (len(pieces) > 3):
             shortcut = pieces[1].lower()
             if shortcut == "youtube":
-                line = line.replace(s, '[' + mapLinkLabels.get(pieces[2],'youtube ' + pieces[2]) + '](https://www.youtube.com/watch?v=' + pieces[2] + ')')
+                return '[' + mapLinkLabels.get(pieces[2],'youtube ' + pieces[2]) + '](https://www.youtube.com/watch?v=' + pieces[2] + ')'
             elif shortcut == "instagram":
-                line = line.replace(s,'[' + mapLinkLabels.get(pieces[2],'instagram ' + pieces[2]) + '](https://www.instagram.com/p/' + pieces[2] + '/)')
-    return line
+                return '[' + mapLinkLabels.get(pieces[2],'instagram ' + pieces[2]) + '](https://www.instagram.com/p/' + pieces[2] + '/)'
+        return match.group()
+
+    if not '{{' in line:
+        return line
+    return re_shortcut.sub(shortcut_link, line)
 
 
+##  Memoized lines ##
+##
+## Most pages end with the same boilerplate (menu, categories, social links,
+## return home, and author), so the same lines are converted again and again.
+## The steps that only depend on the line and on the options are memoized in
+## bounded caches (the links are still extracted for each page, as their
+## reference numbers belong to the page). The caches are cleared when the
+## map changes (see compile_map_replace), and the other options are part
+## of the keys.
+
+lineCacheSize = 4096 # Lines kept by each cache
+
+@functools.lru_cache(maxsize = lineCacheSize)
+def clean_line(line):
+    # Replace the mapped text, and clean the html tags and the hugo shortcuts
+    return clean_hugo_shortcuts(clean_html_tags(replace_mapped_text(line)))
+
+
+## Inline markdown (see clean_markdown)
+re_inline_chars = re.compile(r"[*_`]")
+re_code         = re.compile(r"(?<!`)```.*?```|(?<!`)``.*?``|(?<!`)`[^`]+`")
+re_asterisks    = re.compile(r"\*+[^\*]+\*+")
+re_underscores  = re.compile(r"(?<![^\W_])_+[^_]+_+(?![^\W_])") ## Not intraword (like snake_case)
+codeMark = '\ue000' ## Private use character, to hide the code while stripping emphasis
+
+@functools.lru_cache(maxsize = lineCacheSize)
 def clean_markdown(line, add_LF = False):
-    # strip bold and italic enclosed in asterisk (*)
-    emphasis = re.findall(r'\*+[^\*]+\*+',line)
-    for item in emphasis:
-        new = item
-        while (new[0] == '*') and (new[-1] == '*'):
-            new = new[1:-1]
-        line = line.replace(item, new)
-    # strip bold and italic enclosed in underscore (_)
-    emphasis = re.findall(r'_+[^_]+_+',line)
-    for item in emphasis:
-        new = item
-        while (new[0] == '_') and (new[-1] == '_'):
-            new = new[1:-1]
-        line = line.replace(item, new)
-    # strip code enclosed in three backticks (```)
-    emphasis = re.findall(r"(?<!`)```.*?```",line)
-    for item in emphasis:
-        line = line.replace(item, item[2:-2])
-    # strip code enclosed in two backticks (``)
-    emphasis = re.findall(r"(?<!`)``.*?``",line)
-    for item in emphasis:
-        line = line.replace(item, item[2:-2])
-    # strip code enclosed in one backticks (`)
-    emphasis = re.findall(r"(?<!`)`[^`]+`",line)
-    for item in emphasis:
-        line = line.replace(item, item[1:-1])
+    # Strip code enclosed in three, two, or one backticks (```, ``, `), and bold and italic
+    # enclosed in asterisks (*) or underscores (_). Each is a single re.sub scan of the line,
+    # and lines without any of those characters are not scanned at all.
+    # Code is literal, so it is hidden from the emphasis scans (but emphasis can enclose code)
+    def strip_code(match):
+        item = match.group()
+        n = 3 if item.startswith('```') else 2 if item.startswith('``') else 1
+        code.append(item[n:-n])
+        return codeMark
+
+    def strip_emphasis(match):
+        item = match.group()
+        mark = item[0]
+        while (item[0] == mark) and (item[-1] == mark):
+            item = item[1:-1]
+        return item
+
+    if re_inline_chars.search(line):
+        code = []
+        if '`' in line and not codeMark in line:
+            line = re_code.sub(strip_code, line)
+        if '*' in line:
+            line = re_asterisks.sub(strip_emphasis, line)
+        if '_' in line:
+            line = re_underscores.sub(strip_emphasis, line)
+        if code:
+            code = iter(code)
+            line = re.sub(codeMark, lambda match: next(code), line)
     if add_LF:
         line = line.rstrip('\r\n ') + '\n'
     return line
@@ -469,10 +992,11 @@ def clean_markdown(line, add_LF = False):
 ##
 ######### CHECK http://www.rexegg.com/regex-uses.html
 
+re_links = re.compile(r'!?\[[^\]]*\]\([^\)]*\)|<[^<]+[@:][^<]+>')
+
 def extract_links(line, pageLinks, ignoreLinks = False):
-    lineLinks = re.findall(r'!?\[[^\]]*\]\([^\)]*\)|<[^<]+[@:][^<]+>',line)
-    for link in lineLinks:
-        original_link = link
+    def cite_link(match):
+        link = match.group()
         if link[0] == '<' and link[-1] == '>':
             lk = link[1:-1]
             if re.search(r'^[a-zA-Z][.\w-]*@[.\w-]+$',lk):
@@ -482,15 +1006,18 @@ def extract_links(line, pageLinks, ignoreLinks = False):
         #link = re.sub(r'%25','%',link)
         if not (link in pageLinks):
             pageLinks[link] = len(pageLinks) + 1
+        runCounters['links extracted'] += 1
         ref = link.split('](')
         if len(ref) != 2:
-            error(" Invalid link '",src,"', line ",count,":",link);
+            error(" Invalid link: ",link);
         citeId = ' [' + str(pageLinks[link]) + ']' 
         if ref[0][0] == '!':
-            cite = ref[0][2:] + (citeId if not ignoreLinks else "")
+            return ref[0][2:] + (citeId if not ignoreLinks else "")
         else:
-            cite = ref[0][1:] + (citeId if not ignoreLinks else "")
-        line = line.replace(original_link,cite)
+            return ref[0][1:] + (citeId if not ignoreLinks else "")
+
+    if '[' in line or '<' in line:
+        line = re_links.sub(cite_link, line)
     return line, (pageLinks if not ignoreLinks else {})
 
 
@@ -512,47 +1039,128 @@ def one_line_link(line):
     return single
 
 
-def convert_gopher(src, dst, arPath, arLast, arBase):
-
-    def justify (txt, text_width):
-        missing = text_width - len(txt)
-        leading = 0
-        if missing == 0:
-            return txt
-        while txt[leading] == ' ':
-            txt = txt[1:]
-            leading += 1
-        words = txt.split()
-        blanks = re.findall(r'\s+', txt.strip())
-        nblanks = len(words) - 1
-        if nblanks != len(blanks):
-            error("INTERNAL Error mistmatch of spaces (nblanks:",nblanks,
-                    " len(blanks):",len(blanks),
-                    "\nwords:",words,"\nblanks:",blanks,"\nTXT:|",txt,"|")
-        if nblanks < 1:
-            warn("Line too long without a blank (",nblanks, ")=>[",words,"]")
-
-        while (missing >= nblanks) and (nblanks > 0):
-            for i in range(len(blanks)):
-                blanks[i] += ' '
-            missing -= nblanks
-
-        flags = [True] * (nblanks)
-
-        while (missing > 0) and (nblanks > 0):
-            i = random.randint(0,nblanks-1)
-            if flags[i]:
-                blanks[i] += ' '
-                flags[i] = False
-                missing -= 1
-
-        text = ''
-        if leading > 0:
-            text = ' ' * leading
-        for i in range(len(blanks)):
-            text += words[i] + blanks[i]
-        text += words[-1]
-        return text
+## Gopher item types by file extension (see build_item_types)
+itemTypes = {}
+mimeTypes = mimetypes.MimeTypes()
+
+def mime_item_type(mime):
+    # Gopher item type of a mime type (None when the mime type is unknown)
+    if not mime:
+        return None
+    mm = mime.split('/')
+    if mime == 'image/gif':
+        return 'g' # GIF graphic
+    elif mime == 'text/html':
+        return 'h' # HTML file
+    elif mm[0] == 'text':
+        return '0' # Plain text
+    elif (mm[0] == 'application') or (mm[0] == 'video'):
+        return '9' # Binary (including pdf)
+    elif mm[0] == 'image':
+        return 'I' # grafic files other than GIF
+    elif mm[0] == 'audio':
+        return 's' # Sound file
+    return '9' # default to Binary
+
+
+def build_item_types():
+    # Classify every extension known to mimetypes once per run, and then
+    # apply the overrides from the map file (for example: .epub = 9)
+    global itemTypes
+    itemTypes = {ext: mime_item_type(mime) for ext, mime in mimeTypes.types_map[True].items()}
+    itemTypes.update(mapItemTypes)
+    guess_item_type.cache_clear()
+
+
+@functools.lru_cache(maxsize=1024)
+def guess_item_type(uri):
+    # For the few links that the extension table can not classify
+    # (e.g. compressed files, upper case extensions or no extension at all)
+    ext = posixpath.splitext(uri)[1].lower()
+    if ext in mapItemTypes:
+        return mapItemTypes[ext]
+    item = mime_item_type(mimeTypes.guess_type(uri)[0])
+    if not item:
+        if uri.endswith('gophermap'):
+            return '0' # text file
+        return '1' # Assume directory
+    return item
+
+
+def item_type(uri, hint):
+    # Gopher item type of a link. Only links within the site (that start
+    # with '/') are classified, for the rest the hint is used
+    if uri[0] != '/':
+        return hint
+    return itemTypes.get(posixpath.splitext(uri)[1]) or guess_item_type(uri)
+
+
+@functools.lru_cache(maxsize=None)
+def text_wrapper(width):
+    return textwrap.TextWrapper(width = width)
+
+
+def justify_line(txt, width):
+    # Spread the blanks between the words of txt, so it is width characters long.
+    # The spread only depends on the line, so rebuilding the site gives the same gophermaps.
+    # Depending on textAlign the extra blanks go to:
+    #    justify  evenly spaced gaps
+    #    random   random gaps (seeded by the line, and by textSeed when given)
+    #    left     nowhere (the line is not justified)
+    leading = len(txt) - len(txt.lstrip(' '))
+    words = txt.split()
+    nblanks = len(words) - 1
+    if textAlign == 'left' or len(txt) == width:
+        return txt
+    if nblanks < 1:
+        warn("Line too long without a blank (",nblanks, ")=>[",words,"]")
+        return txt
+    size, extra = divmod(width - leading - sum(map(len, words)), nblanks)
+    if textAlign == 'random':
+        wide = [False] * nblanks
+        for i in random.Random(textSeed + '\0' + txt if textSeed else txt).sample(range(nblanks), extra):
+            wide[i] = True
+    else: ## Bresenham spread of the extra blanks
+        wide = [((i + 1) * extra) // nblanks != (i * extra) // nblanks for i in range(nblanks)]
+    pieces = [' ' * leading]
+    for i in range(nblanks):
+        pieces.append(words[i])
+        pieces.append(' ' * (size + 1) if wide[i] else ' ' * size)
+    pieces.append(words[-1])
+    return ''.join(pieces)
+
+
+def wrap_text(txt, width):
+    # Wrap txt to lines of width characters, and justify all but the last line
+    lines = text_wrapper(width).wrap(txt)
+    return [justify_line(line, width) for line in lines[:-1]] + lines[-1:]
+
+
+textLines = collections.OrderedDict() # (text, width, align) -> gopher text lines (see text_lines)
+
+def text_lines(text, convert):
+    # Memoized convert(text) of a gopher text line (see gopher_page). The lines
+    # that give a warning are not kept, so it is still given for each page
+    key = (text, gopherLineLength, textAlign, textSeed)
+    lines = textLines.get(key)
+    if lines is not None:
+        textLines.move_to_end(key)
+        runCounters['text lines reused'] += 1
+        return lines
+    count = warnCount
+    lines = convert(text)
+    if count == warnCount:
+        textLines[key] = lines
+        if len(textLines) > lineCacheSize:
+            textLines.popitem(last = False)
+    return lines
+
+
+def gopher_page(flSrc, flDst, src, dst, arBase, links = None):
+    # Convert the lines of flSrc (a Markdown_reader) to a gophermap written to flDst.
+    # src and dst only name the page in the messages. The selectors of the
+    # internal links of the page are appended to links (see check_links).
+    # Returns False when the page must be copied from the last build (ggCopyPage)
 
     def gopher_text(txt, prefix = ''):
         lines = []
@@ -597,398 +1205,863 @@ def convert_gopher(src, dst, arPath, arLast, arBase):
 
         assert len(initial_ident) == len(subsequent_indent)
         
-        lines = textwrap.wrap(txt, width = txt_width - len(initial_ident))
+        lines = wrap_text(txt, txt_width - len(initial_ident))
         last = len(lines) -1
         for i in range(0, last+1):
-            if i == last:
-                lines[i] = prefix + (subsequent_indent if i > 0 else initial_ident) + lines[i]
-            elif i == 0:
-                lines[i] = prefix + initial_ident + justify(lines[i], txt_width)
-            else:
-                lines[i] = prefix + subsequent_indent + justify(lines[i], txt_width)
+            lines[i] = prefix + (subsequent_indent if i > 0 else initial_ident) + lines[i]
 
         if isHeader and (last == 0):
             lines.append(prefix)
 
         return lines
 
-    def item_type(uri, hint):
-        item = hint
-        if uri[0] == '/':
-            mime = mimetypes.MimeTypes().guess_type(uri)[0]
-            if not mime:
-                if uri.endswith('gophermap'):
-                    return '0' # text file
-                else:
-                    return '1' # Assume directory
-            mm = mime.split('/')
-            if mime == 'image/gif':
-                item = 'g' # GIF graphic
-            elif mime == 'text/html':
-                item = 'h' # HTML file
-            elif mm[0] == 'text':
-                item = '0' # Plain text
-            elif (mm[0] == 'application') or (mm[0] == 'video'):
-                item = '9' # Binary (including pdf)
-            elif mm[0] == 'image':
-                item = 'I' # grafic files other than GIF
-            elif mm[0] == 'audio':
-                item = 's' # Sound file
-            else:
-                item = '9' # default to Binary
-        return item
-
     # Notes on gophermap syntax (https://tools.ietf.org/html/rfc1436): 
     # 1- gopher text lines should be keep to 70 chars (or 67 chars)
     # 2- lines must end with <CR><LF> (meaning '\r\n')
-    vbprint("CONVERT Gophermap:",src,"->",dst)
     replacePage = False
     addItemForText = False
-    try:
-        count = 0
-        countOtherLinks = 0
-        isFenced = False # Fencing means that it inside a clode block that start with three back tildes (``` code ```)
-        skipLine =False
-        pageLinks = {}
-        lineEnd = '\r\n'
-        arg = {}
-        filler = ""
-
-        flSrc = Markdown_reader(src, True)
-        flDst = open(dst, 'wt')
-
-        def print_references(prefix):
-            if len(pageLinks) == 0:
-                return
-            nonlocal countOtherLinks
-            countOtherLinks  += 1
-            if prefix == 'i':
-                flDst.write(prefix + '\t' + filler + lineEnd + prefix + 
-                        'References:\t' + filler + lineEnd)
-            else:
-                flDst.write(lineEnd + 'References:' + lineEnd)
-            for key, value in sorted(pageLinks.items(), key=lambda item: item[1]):
-                ref = key.split('](')
-                hint = 'I' if ref[0][0] == '!' else 'h'
-                label = clean_markdown(ref[0][2:] if ref[0][0] == '!' else ref[0][1:])
-                uri = ref[1][:-1]
-                lineItem = item_type(uri, hint)
-                if lineItem == 'h':
-                    uri = 'URL:' + uri
-                flDst.write(lineItem + '  [' + str(value) + '] ' + label + '\t'
-                        + (arBase if uri[0] == '/' else '') + uri + filler + lineEnd)
-
-
-        def break_gopher_line(line):
-            #line is: <item><text>[<TAB><selector>[<TAB><host>[<TAB><port>]]]<CR><LF>
-            parts = line.split('\t')
-            n = len(parts)
-            port = '' if n < 4 else parts[3]
-            host = '' if n < 3 else parts[2]
-            sele = '' if n < 2 else parts[1]
-            text = '' if n == 0 else parts[0]
-            item = ''
-            if len(text) > 0:
-                item = text[0]
-                text = text[1:]
-            return item, text, sele, host, port
-
-        def g_line(item, text, sele, host, port):
-            if not addItemForText and item == 'i':
-                line =  text
-            else:
-                line = item + text
-            if item == 'h' and not sele.startswith("URL:"):
-                sele = 'URL:' + sele
-            line += '' if not sele and not host and not port else '\t' + sele
-            line += '' if              not host and not port else '\t' + host
-            line += '' if                           not port else '\t' + port
-            return line + lineEnd
+    count = 0
+    countOtherLinks = 0
+    isFenced = False # Fencing means that it inside a clode block that start with three back tildes (``` code ```)
+    skipLine =False
+    pageLinks = {}
+    lineEnd = '\r\n'
+    arg = {}
+    filler = ""
 
-        while True:
-            line = flSrc.get_line(isFenced)
-            if not line: ## Note that empty lines comming from the file have at least a '\n' on them
+    def print_references(prefix):
+        if len(pageLinks) == 0:
+            return
+        runCounters['references emitted'] += len(pageLinks)
+        nonlocal countOtherLinks
+        countOtherLinks  += 1
+        if prefix == 'i':
+            flDst.write(prefix + '\t' + filler + lineEnd + prefix + 
+                    'References:\t' + filler + lineEnd)
+        else:
+            flDst.write(lineEnd + 'References:' + lineEnd)
+        for key, value in sorted(pageLinks.items(), key=lambda item: item[1]):
+            ref = key.split('](')
+            hint = 'I' if ref[0][0] == '!' else 'h'
+            label = clean_markdown(ref[0][2:] if ref[0][0] == '!' else ref[0][1:])
+            uri = ref[1][:-1]
+            lineItem = item_type(uri, hint)
+            if lineItem == 'h':
+                uri = 'URL:' + uri
+            elif uri[0] == '/' and links is not None:
+                links.append(arBase + uri)
+            flDst.write(lineItem + '  [' + str(value) + '] ' + label + '\t'
+                    + (arBase if uri[0] == '/' else '') + uri + filler + lineEnd)
+
+
+    def break_gopher_line(line):
+        #line is: <item><text>[<TAB><selector>[<TAB><host>[<TAB><port>]]]<CR><LF>
+        parts = line.split('\t')
+        n = len(parts)
+        port = '' if n < 4 else parts[3]
+        host = '' if n < 3 else parts[2]
+        sele = '' if n < 2 else parts[1]
+        text = '' if n == 0 else parts[0]
+        item = ''
+        if len(text) > 0:
+            item = text[0]
+            text = text[1:]
+        return item, text, sele, host, port
+
+    def g_line(item, text, sele, host, port):
+        if not addItemForText and item == 'i':
+            line =  text
+        else:
+            line = item + text
+        if item == 'h' and not sele.startswith("URL:"):
+            sele = 'URL:' + sele
+        elif (links is not None and sele[0:1] == '/' and not item in ['i', '3', 'h']
+                and (not host or host == arg.get('host'))): ## Internal link
+            links.append(sele)
+        line += '' if not sele and not host and not port else '\t' + sele
+        line += '' if              not host and not port else '\t' + host
+        line += '' if                           not port else '\t' + port
+        return line + lineEnd
+
+    while True:
+        line = flSrc.get_line(isFenced)
+        if not line: ## Note that empty lines comming from the file have at least a '\n' on them
+            break
+        if len(line) > 6 and line.startswith("i+++") and line.strip('\r\n').endswith("+++"):
+            continue #### This is a kludge to avoid debugging get_line()
+        if (count == 0) and not arg:
+            arg = extract_arg(line) # Extract the arguments from the first line of the file.
+            if (fullGopherLine  or (arg and (arg['textChar'] or arg['fullLine']))):
+                addItemForText = True
+            if arg and arg['copyPage']:
+                replacePage = True
                 break
-            if len(line) > 6 and line.startswith("i+++") and line.strip('\r\n').endswith("+++"):
-                continue #### This is a kludge to avoid debugging get_line()
-            if (count == 0) and not arg:
-                arg = extract_arg(line) # Extract the arguments from the first line of the file.
-                if (fullGopherLine  or (arg and (arg['textChar'] or arg['fullLine']))):
-                    addItemForText = True
-                if arg and arg['copyPage']:
-                    replacePage = True
-                    break
-                if arg or (len(line.strip('\r\n\t ')) == 0):
-                    continue
-            count += 1
-            if arg and arg['keepRaw']:
-                flDst.write(line)
-                continue
-            line = line.rstrip('\r\n') # remove trailing <CR> and/or <LF>
-            if not isFenced and (line == 'i---' or line == 'i+++'):
-                skipLine = not skipLine 
+            if arg or (len(line.strip('\r\n\t ')) == 0):
                 continue
-            if skipLine:
+        count += 1
+        if arg and arg['keepRaw']:
+            flDst.write(line)
+            continue
+        line = line.rstrip('\r\n') # remove trailing <CR> and/or <LF>
+        if not isFenced and (line == 'i---' or line == 'i+++'):
+            skipLine = not skipLine 
+            continue
+        if skipLine:
+            continue
+        if re.search(r"^i?\s*```",line): #toggle fenced code
+            isFenced  = not isFenced
+            continue
+        if isFenced or ((len(line) > 4) and ((line[0:5] == 'i    ') or (line[0:2] == 'i\t'))):
+            linePart = line.split('\t')
+            if len(linePart[0]) > gopherLineLength:
+                warn("Fenced line too long (exceed ",gopherLineLength," chars by ",
+                        len(line.split('\t',1)[0])-gopherLineLength," chars) in '",
+                        src,"', line ",flSrc.get_count())
+            if linePart[0][0] != 'i':
+                error("Non 'i' Fenced line") 
+
+            flDst.write(line + ('\t/' if len(linePart) < 2 else '') + lineEnd)
+            continue
+        if line.strip() == '[[[=> references <=]]]':
+            print_references('i' if addItemForText else '')
+            continue
+
+        # Strict gopher: lines are composed of five parts:
+        # item: one character describing the item type
+        #    it is one of the following: (see 'https://en.wikipedia.org/wiki/Gopher_(protocol)')
+        #    Canonical types
+        #    "0"  Text file
+        #    "1"  Gopher directory (may contain a gophermap)
+        #    "2"  CCSO Nameserver
+        #    "3"  Error code returned by a Gopher server to indicate failure
+        #    "4"  BinHex-encoded file (primarily for Macintosh computers)
+        #    "5"  DOS file
+        #    "6"  uuencoded file
+        #    "7"  Gopher full-text search
+        #    "8"  Telnet
+        #    "9"  Binary file
+        #    "+"  Mirror or alternate server (for load balancing or in case of primary server downtime)
+        #    "g"  GIF file
+        #    "I"  Image file
+        #    "T"  Telnet 3270
+        #    Gopher+ types
+        #    ":"  Bitmap image
+        #    ";"  Movie file
+        #    "<"  Sound file
+        #    Non-canonical types
+        #    "d"  Doc. Seen used alongside PDF's and .DOC's
+        #    "h"  HTML file
+        #    "i"  Informational message, widely used. Just plain text to display
+        #    "p"  image file "(especially the png format)"
+        #    "r"  document rtf file "rich text Format")
+        #    "s"  Sound file (especially the WAV format)
+        #    "P"  document pdf file "Portable Document Format")
+        #    "X"  document xml file "eXtensive Markup Language")
+        # text: user visible string or label
+        # selector: often a path, uri or other file selector
+        # host: the domain name of the host containing the selector
+        # port: the port used by the host
+        #
+        #line is: <item><text>[<TAB><selector>[<TAB><host>[<TAB><port>]]]<CR><LF>
+        #
+        item, text, selector, host, port = break_gopher_line(line.replace('gophermap.txt','gophermap'))
+
+        if item == '1' and not selector:
+            selector = '/'  ## Force it to the begining the alternative is to ignore the line
+
+        if item in ['0','1','4','5','6','9','g','I','h','s']:
+            countOtherLinks += 1
+
+        if fullGopherLine or (arg and arg['fullLine']):
+            if not host:
+                host = arg['host']
+            if not port:
+                port = arg['port']
+            if item == 'i':
+                selector = '/'
+                host = ''
+                port = ''
+
+        # need to  clean up stuff
+        if item == '1' and re.search(r'^\s*\/gopher\/',selector):
+            selector = selector.replace("/gopher/","/")
+
+        text = clean_line(text)
+
+        # need to extract and replace links [text](link)
+        # Links alone in a single line shoul be placed in the same line
+        if item == 'i':
+            single = one_line_link(text)
+            if single:
+                if arg and arg['ignoreLinks']:
+                    flDst.write(g_line(item, single['label'], '', host, port))
+                    #flDst.write(single['label'] + lineEnd)
+                else:
+                    flDst.write(g_line(item_type(single['uri'], single['hint']), single['label'], single['uri'], host, port))
+                    #flDst.write(item_type(single['uri'], single['hint']) + '  ' + single['label'] + '\t' + single['uri'] + filler + lineEnd)
                 continue
-            if re.search(r"^i?\s*```",line): #toggle fenced code
-                isFenced  = not isFenced
+
+            # Links embeded in the text of the line must be collected for late placement
+            text, pageLinks = extract_links(text, pageLinks, arg and arg['ignoreLinks'])
+
+        text = clean_markdown(text)
+        if item == 'i': ### Text line
+            lines = text_lines(text, gopher_text)
+            for l in lines:
+                flDst.write(g_line(item, l, selector, host, port))
+                #flDst.write(lne + filler + lineEnd)
+            continue
+        elif item == '1': ### Directory line
+            if selector.rstrip().endswith('gophermap'):
+                selector = selector.strip()[:-9].rstrip(os.sep)
+                flDst.write(g_line(item, text, selector, host, port))
+                #flDst.write(lne + filler + lineEnd)
                 continue
-            if isFenced or ((len(line) > 4) and ((line[0:5] == 'i    ') or (line[0:2] == 'i\t'))):
-                linePart = line.split('\t')
-                if len(linePart[0]) > gopherLineLength:
-                    warn("Fenced line too long (exceed ",gopherLineLength," chars by ",
-                            len(line.split('\t',1)[0])-gopherLineLength," chars) in '",
-                            src,"', line ",flSrc.get_count())
-                if linePart[0][0] != 'i':
-                    error("Non 'i' Fenced line") 
-
-                flDst.write(line + ('\t/' if len(linePart) < 2 else '') + lineEnd)
+
+        flDst.write(g_line(item, text, selector, host, port))
+        #flDst.write(line + filler + lineEnd)
+
+    if countOtherLinks  == 0:
+        warn("No links in '",src,"' convert to '",dst,
+                    "', it should be a txt file (instead of a gophermap)")
+    return not replacePage
+
+
+def gemini_page(flSrc, flDst, src, dst, arBase, links = None):
+    # Convert the lines of flSrc (a Markdown_reader) to a gemini page written to flDst.
+    # src and dst only name the page in the messages. The paths of the
+    # internal links of the page are appended to links (see check_links).
+    # Returns False when the page must be copied from the last build (ggCopyPage)
+
+    replacePage = False
+    count = 0
+    emptyLines = 0
+    isFenced = False
+    skipLine =False
+    pageLinks = {}
+    arg = {}
+
+    def print_references():
+        if len(pageLinks) == 0:
+            return
+        runCounters['references emitted'] += len(pageLinks)
+        flDst.write('\nReferences:\n')
+        for key, value in sorted(pageLinks.items(), key=lambda item: item[1]):
+            ref = key.split('](')
+            label = clean_markdown(ref[0][1:])
+            uri = (arBase if ref[1][0] == '/' else '') + urllib.parse.quote(ref[1][:-1],':/?=+&')
+            if ref[1][0] == '/' and links is not None:
+                links.append(uri)
+            flDst.write('=> ' + uri + '  [' + str(value) + '] ' + label + '\n')
+        #flDst.write('\n')
+
+    while True:
+        line = flSrc.get_line(isFenced)
+        if not line: ## Note that empty lines comming from the file have at least a '\n' on them
+            break
+        if len(line) > 6 and line.startswith("+++") and line.strip('\r\n').endswith("+++"):
+            continue #### This is a kludge to avoid debugging get_line()
+        if (count == 0) and not arg:
+            arg = extract_arg(line)
+            if arg and arg['copyPage']:
+                replacePage = True
+                break
+            if arg or (len(line.strip('\r\n\t ')) == 0):
                 continue
-            if line.strip() == '[[[=> references <=]]]':
-                print_references('i' if addItemForText else '')
+        count += 1
+
+        ## Note that gemini lines can end on <CR><LF> or just in <LF>
+        ## so, we don't need to worry as much as with gopher
+        if arg and arg['keepRaw']:
+            flDst.write(line)
+            continue
+        if not isFenced and line.strip('\r\n') in ['---', '+++']:
+            skipLine = not skipLine 
+            continue
+        if skipLine:
+            continue
+        if re.search(r"^\s*```",line): #toggle fenced code
+            flDst.write(line.strip('\t\r\n ') + '\n')
+            isFenced  = not isFenced
+            emptyLines = 0
+            continue
+        if isFenced or ((len(line) > 3) and ((line[0:4] == '    ') or (line[0:1] == '\t'))):
+            flDst.write(line.rstrip('\r\n ') + '\n')
+            continue
+
+        # need to  clean up stuff
+        #print(":LINE:[",line.rstrip('\r\n'),"]",sep='')
+        if line.rstrip('\r\n') == '':
+            emptyLines += 1
+            if emptyLines > maxEmptyLines:
                 continue
+        else:
+            emptyLines = 0
+
+        if line[0:2] == '=>':
+            if re.search(r'=>\s*\/gemini\/',line):
+                line = line.replace("/gemini/","/")
+            if re.search(r'\/gemini-page\.gmi\s+',line):
+                line = line.replace("/gemini-page.gmi",".gmi")
+            line = line.replace("/.gmi",".gmi")
+            if line.find("=> .gmi") == 0:
+                line = "BAD LINE[" + line + "]"
+
+        line = clean_line(line)
+
+        # need to extract and replace links [text]()
+        # Links alone in a single line shoul be placed in the same line
+        single = one_line_link(line.strip('\r\n'))
+        if single:
+            #flDst.write('=> ' + single['uri'] + '   ' + single['label'] + '\n')
+            #print('OUT1:[=> ' + urllib.parse.quote(single['uri'],':/?=+&') + '   ' + single['label'] + ']',sep='')
+            uri = urllib.parse.quote(single['uri'],':/?=+&')
+            if uri[0:1] == '/' and links is not None:
+                links.append(uri)
+            flDst.write('=> ' + uri + '   ' + single['label'] + '\n')
+            continue
 
-            # Strict gopher: lines are composed of five parts:
-            # item: one character describing the item type
-            #    it is one of the following: (see 'https://en.wikipedia.org/wiki/Gopher_(protocol)')
-            #    Canonical types
-            #    "0"  Text file
-            #    "1"  Gopher directory (may contain a gophermap)
-            #    "2"  CCSO Nameserver
-            #    "3"  Error code returned by a Gopher server to indicate failure
-            #    "4"  BinHex-encoded file (primarily for Macintosh computers)
-            #    "5"  DOS file
-            #    "6"  uuencoded file
-            #    "7"  Gopher full-text search
-            #    "8"  Telnet
-            #    "9"  Binary file
-            #    "+"  Mirror or alternate server (for load balancing or in case of primary server downtime)
-            #    "g"  GIF file
-            #    "I"  Image file
-            #    "T"  Telnet 3270
-            #    Gopher+ types
-            #    ":"  Bitmap image
-            #    ";"  Movie file
-            #    "<"  Sound file
-            #    Non-canonical types
-            #    "d"  Doc. Seen used alongside PDF's and .DOC's
-            #    "h"  HTML file
-            #    "i"  Informational message, widely used. Just plain text to display
-            #    "p"  image file "(especially the png format)"
-            #    "r"  document rtf file "rich text Format")
-            #    "s"  Sound file (especially the WAV format)
-            #    "P"  document pdf file "Portable Document Format")
-            #    "X"  document xml file "eXtensive Markup Language")
-            # text: user visible string or label
-            # selector: often a path, uri or other file selector
-            # host: the domain name of the host containing the selector
-            # port: the port used by the host
-            #
-            #line is: <item><text>[<TAB><selector>[<TAB><host>[<TAB><port>]]]<CR><LF>
-            #
-            item, text, selector, host, port = break_gopher_line(line.replace('gophermap.txt','gophermap'))
-
-            if item == '1' and not selector:
-                selector = '/'  ## Force it to the begining the alternative is to ignore the line
-
-            if item in ['0','1','4','5','6','9','g','I','h','s']:
-                countOtherLinks += 1
-
-            if fullGopherLine or (arg and arg['fullLine']):
-                if not host:
-                    host = arg['host']
-                if not port:
-                    port = arg['port']
-                if item == 'i':
-                    selector = '/'
-                    host = ''
-                    port = ''
-
-            # need to  clean up stuff
-            if item == '1' and re.search(r'^\s*\/gopher\/',selector):
-                selector = selector.replace("/gopher/","/")
-
-            text = replace_mapped_text(text)
-            text = clean_html_tags(text)
-            text = clean_hugo_shortcuts(text)
-
-            # need to extract and replace links [text](link)
-            # Links alone in a single line shoul be placed in the same line
-            if item == 'i':
-                single = one_line_link(text)
-                if single:
-                    if arg and arg['ignoreLinks']:
-                        flDst.write(g_line(item, single['label'], '', host, port))
-                        #flDst.write(single['label'] + lineEnd)
-                    else:
-                        flDst.write(g_line(item_type(single['uri'], single['hint']), single['label'], single['uri'], host, port))
-                        #flDst.write(item_type(single['uri'], single['hint']) + '  ' + single['label'] + '\t' + single['uri'] + filler + lineEnd)
-                    continue
+        # Links embeded in the text of the line must be collected for late placement
+        line, pageLinks = extract_links(line, pageLinks, arg and arg['ignoreLinks'])
 
-                # Links embeded in the text of the line must be collected for late placement
-                text, pageLinks = extract_links(text, pageLinks, arg and arg['ignoreLinks'])
+        if line.strip() == '[[[=> references <=]]]':
+            print_references()
+            continue
 
-            text = clean_markdown(text)
-            if item == 'i': ### Text line
-                lines = gopher_text(text) 
-                for l in lines:
-                    flDst.write(g_line(item, l, selector, host, port))
-                    #flDst.write(lne + filler + lineEnd)
-                continue
-            elif item == '1': ### Directory line
-                if selector.rstrip().endswith('gophermap'):
-                    selector = selector.strip()[:-9].rstrip(os.sep)
-                    flDst.write(g_line(item, text, selector, host, port))
-                    #flDst.write(lne + filler + lineEnd)
-                    continue
+        if len(line) > 2 and line[0:2] == '=>':
+            uri = line[2:].split(None, 1)
+            if uri and uri[0][0] == '/' and links is not None:
+                links.append(uri[0])
+            flDst.write(line)
+        else:
+            #print("OUT2:[",clean_markdown(line, True),"]",sep='')
+            flDst.write(clean_markdown(line, True))
+
+    return not replacePage
 
-            flDst.write(g_line(item, text, selector, host, port))
-            #flDst.write(line + filler + lineEnd)
 
-        if countOtherLinks  == 0:
-            warn("No links in '",src,"' convert to '",dst,
-                        "', it should be a txt file (instead of a gophermap)")
+def convert_page_file(isGopher, src, dst, arPath, arLast, arBase, links = None):
+    # Convert the page src to dst, deleting src (see gopher_page and gemini_page)
+    try:
+        flSrc = Markdown_reader(src, isGopher)
+        flDst = page_buffer()
+        converted = (gopher_page if isGopher else gemini_page)(flSrc, flDst, src, dst,
+                arBase, links)
         flSrc.destroy()
-        flDst.close()
+        if not converted:
+            with open(dst.replace(arPath, arLast, 1), 'rb') as flLast:
+                write_page(dst, flLast.read())
+        else:
+            write_page(dst, flDst)
         delete_file(src)
-        if replacePage:
-            delete_file(dst, False)
-            clone_file(dst.replace(arPath, arLast, 1), dst)
 
     except OSError as e:
         error(e, " while processing files", src,"=>",dst)
 
 
-def convert_gemini(src, dst, arPath, arLast, arBase):
+def convert_gopher(src, dst, arPath, arLast, arBase, links = None):
+    vbprint("CONVERT Gophermap:",src,"->",dst)
+    convert_page_file(True, src, dst, arPath, arLast, arBase, links)
+
 
+def convert_gemini(src, dst, arPath, arLast, arBase, links = None):
     vbprint("CONVERT Gemini map:",src,"->",dst)
-    replacePage = False
-    try:
-        count = 0
-        emptyLines = 0
-        isFenced = False
-        skipLine =False
-        pageLinks = {}
-        arg = {}
-
-        def print_references():
-            if len(pageLinks) == 0:
-                return
-            flDst.write('\nReferences:\n')
-            for key, value in sorted(pageLinks.items(), key=lambda item: item[1]):
-                ref = key.split('](')
-                label = clean_markdown(ref[0][1:])
-                if ref[0][0] == '!':
-                    flDst.write('=> ' + (arBase if ref[1][0] == '/' else '')
-                            + urllib.parse.quote(ref[1][:-1],':/?=+&') 
-                            + '  [' + str(value) + '] ' + label + '\n')
-                else:
-                    flDst.write('=> ' + (arBase if ref[1][0] == '/' else '')
-                            + urllib.parse.quote(ref[1][:-1],':/?=+&')
-                            + '  [' + str(value) + '] ' + label + '\n')
-            #flDst.write('\n')
+    convert_page_file(False, src, dst, arPath, arLast, arBase, links)
 
-        flSrc = Markdown_reader(src, False)
-        flDst = open(dst, 'wt')
 
-        while True:
-            line = flSrc.get_line(isFenced)
-            if not line: ## Note that empty lines comming from the file have at least a '\n' on them
-                break
-            if len(line) > 6 and line.startswith("+++") and line.strip('\r\n').endswith("+++"):
-                continue #### This is a kludge to avoid debugging get_line()
-            if (count == 0) and not arg:
-                arg = extract_arg(line)
-                if arg and arg['copyPage']:
-                    replacePage = True
-                    break
-                if arg or (len(line.strip('\r\n\t ')) == 0):
-                    continue
-            count += 1
+##  In-memory conversion ##
+##
+## To embed the converter (e.g. in a server or other tools), a page as
+## generated by Hugo with this theme can be converted without files:
+##
+##     import hugo2gg
+##     options = hugo2gg.get_options()._replace(gopherLineLength = 67)
+##     gophermap = hugo2gg.convert_gopher_text(page, options)
+##
+## The conversion functions use the module global variables. So, the given
+## options are set (under a lock) only for the conversion, and the previous
+## ones restored after it. When the options are the ones already set (e.g.
+## with set_options) nothing is done, so that is the fastest way to convert
+## many pages with the same options.
+
+optionsLock = threading.RLock()
+
+@contextlib.contextmanager
+def page_options(options):
+    with optionsLock:
+        current = get_options()
+        if options is None or options == current:
+            yield
+            return
+        set_options(options)
+        try:
+            yield
+        finally:
+            set_options(current)
 
-            ## Note that gemini lines can end on <CR><LF> or just in <LF>
-            ## so, we don't need to worry as much as with gopher
-            if arg and arg['keepRaw']:
-                flDst.write(line)
-                continue
-            if not isFenced and line.strip('\r\n') in ['---', '+++']:
-                skipLine = not skipLine 
-                continue
-            if skipLine:
-                continue
-            if re.search(r"^\s*```",line): #toggle fenced code
-                flDst.write(line.strip('\t\r\n ') + '\n')
-                isFenced  = not isFenced
-                emptyLines = 0
-                continue
-            if isFenced or ((len(line) > 3) and ((line[0:4] == '    ') or (line[0:1] == '\t'))):
-                flDst.write(line.rstrip('\r\n ') + '\n')
-                continue
 
-            # need to  clean up stuff
-            #print(":LINE:[",line.rstrip('\r\n'),"]",sep='')
-            if line.rstrip('\r\n') == '':
-                emptyLines += 1
-                if emptyLines > maxEmptyLines:
-                    continue
-            else:
-                emptyLines = 0
-
-            if line[0:2] == '=>':
-                if re.search(r'=>\s*\/gemini\/',line):
-                    line = line.replace("/gemini/","/")
-                if re.search(r'\/gemini-page\.gmi\s+',line):
-                    line = line.replace("/gemini-page.gmi",".gmi")
-                line = line.replace("/.gmi",".gmi")
-                if line.find("=> .gmi") == 0:
-                    line = "BAD LINE[" + line + "]"
-
-            line = replace_mapped_text(line)
-            line = clean_html_tags(line)
-            line = clean_hugo_shortcuts(line)
-
-            # need to extract and replace links [text]()
-            # Links alone in a single line shoul be placed in the same line
-            single = one_line_link(line.strip('\r\n'))
-            if single:
-                #flDst.write('=> ' + single['uri'] + '   ' + single['label'] + '\n')
-                #print('OUT1:[=> ' + urllib.parse.quote(single['uri'],':/?=+&') + '   ' + single['label'] + ']',sep='')
-                flDst.write('=> ' + urllib.parse.quote(single['uri'],':/?=+&') 
-                        + '   ' + single['label'] + '\n')
-                continue
+def convert_text(page, isGopher, options, base, name):
+    with page_options(options):
+        flSrc = Markdown_reader(name, isGopher, page)
+        flDst = io.StringIO()
+        converted = (gopher_page if isGopher else gemini_page)(flSrc, flDst, name, name, base)
+        flSrc.destroy()
+        return flDst.getvalue() if converted else None
 
-            # Links embeded in the text of the line must be collected for late placement
-            line, pageLinks = extract_links(line, pageLinks, arg and arg['ignoreLinks'])
 
-            if line.strip() == '[[[=> references <=]]]':
-                print_references()
-                continue
+def convert_gopher_text(page, options = None, base = '', name = '<page>'):
+    """Convert a gophermap page generated by Hugo (with this theme)
 
-            if len(line) > 2 and line[0:2] == '=>':
-                flDst.write(line)
-            else:
-                #print("OUT2:[",clean_markdown(line, True),"]",sep='')
-                flDst.write(clean_markdown(line, True))
+    Parameters
+    ----------
+    page : str or iterable of str
+        Text of the page, or its lines
+    options : Options
+        Options of the conversion (default to the current ones, see get_options)
+    base : str
+        Rebase the absolute links to base (as --base does)
+    name : str
+        Name of the page in the warnings and errors
 
-        flSrc.destroy()
-        flDst.close()
-        delete_file(src)
-        if replacePage:
-            delete_file(dst, False)
-            clone_file(dst.replace(arPath, arLast, 1), dst)
+    Returns
+    -------
+    str
+        The converted gophermap, or None when the page asks to be copied
+        from the last build (ggCopyPage)
+    """
+
+    return convert_text(page, True, options, base, name)
+
+
+def convert_gemini_text(page, options = None, base = '', name = '<page>'):
+    """Convert a gemini page generated by Hugo (with this theme)
+
+    Parameters
+    ----------
+    page : str or iterable of str
+        Text of the page, or its lines
+    options : Options
+        Options of the conversion (default to the current ones, see get_options)
+    base : str
+        Rebase the absolute links to base (as --Base does)
+    name : str
+        Name of the page in the warnings and errors
 
+    Returns
+    -------
+    str
+        The converted gemini page, or None when the page asks to be copied
+        from the last build (ggCopyPage)
+    """
+
+    return convert_text(page, False, options, base, name)
+
+
+##  Build cache (--cache) ##
+##
+## The cache folder holds a manifest.json file, mapping each page produced by
+## Hugo (relative to the site path) to its key, and a 'pages' folder with the
+## converted output of each key. The key is a hash of the page content, this
+## script, the mapping file, and the options that change the conversion output.
+## So, pages that did not change since the last build are just copied from the
+## cache instead of being converted again.
+
+@functools.lru_cache(maxsize=1)
+def script_digest():
+    try:
+        with open(__file__, 'rb') as fl:
+            return hashlib.sha256(fl.read()).hexdigest()
     except OSError as e:
-        error(e, " while processing files", src,"=>",dst)
+        warn(e, " while reading ", __file__)
+        return ''
+
+
+def build_cache_seed():
+    # Fingerprint of this script and of the options of the run
+    seed = hashlib.sha256(script_digest().encode())
+    seed.update(repr((fullGopherLine, gopherLineLength, textAlign, textSeed, maxEmptyLines,
+        sorted(mapLinkLabels.items()), list(mapReplace.items()),
+        sorted(mapItemTypes.items()))).encode())
+    return seed.hexdigest()
+
+
+def cache_name(key):
+    return os.path.join(cacheFolder, "pages", key[:2], key)
+
+
+def load_build_cache():
+    name = os.path.join(cacheFolder, "manifest.json")
+    if not os.path.isfile(name):
+        return {}
+    try:
+        with open(name, 'rt') as fl:
+            return json.load(fl)
+    except (OSError, ValueError) as e:
+        warn(e, " while reading the build cache manifest ", name)
+        return {}
+
+
+def save_build_cache():
+    # Write the manifest (keeping the entries of the kinds of pages that were
+    # not converted in this run) and remove the pages no longer referenced
+    manifest = load_build_cache()
+    for kind, pages in buildManifest.items():
+        if pages or not kind in manifest:
+            manifest[kind] = pages
+    keys = set()
+    for pages in manifest.values():
+        keys.update(pages.values())
+    for rootDir, subdirs, filenames in os.walk(os.path.join(cacheFolder, "pages")):
+        for filename in filenames:
+            if not filename.split('.')[0] in keys:
+                vbprint("UNCACHE:", filename)
+                try:
+                    os.remove(os.path.join(rootDir, filename))
+                except OSError as e:
+                    warn(e, " while removing ", filename, " from the build cache")
+    try:
+        name = os.path.join(cacheFolder, "manifest.json")
+        with open(name + "-new", 'wt') as fl:
+            json.dump(manifest, fl, indent = 1, sort_keys = True)
+        os.replace(name + "-new", name)
+    except OSError as e:
+        error(e, " while writing the build cache manifest")
 
 
-def traverse_gemini(arGemini, arPath, arLast, arBase):
+def page_timer(convert):
+    # Record the wall and cpu time of each converted page (see --stats)
+    @functools.wraps(convert)
+    def timed(kind, src, dst, *args):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            return convert(kind, src, dst, *args)
+        finally:
+            pageTimes.append((time.perf_counter() - wall, time.process_time() - cpu, kind, dst))
+    return timed
+
+
+@contextlib.contextmanager
+def phase_timer(phase):
+    # Add the wall and cpu time of a phase (see --stats), and
+    # its memory profile (see --profile mem)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        with mem_profiler(phase):
+            yield
+    finally:
+        times = phaseTimes.setdefault(phase, [0.0, 0.0])
+        times[0] += time.perf_counter() - wall
+        times[1] += time.process_time() - cpu
+
+
+##  Profiling (--profile) ##
+##
+## cpu: the run is profiled with cProfile. The workers profile each page and return
+##      the raw stats, which are merged in a .pstats file. A .collapsed file has the
+##      stacks in the format used by flame graph tools. As cProfile only records
+##      caller -> callee edges, the time of each stack is derived from the call graph.
+## mem: tracemalloc snapshots are taken around each phase (and in each worker, at its
+##      first page and at its exit), and the memory allocated and not freed is reported
+##      by the function and line of this script that allocated it (see profileFunctions).
+##      The memory allocated by tracemalloc and by the profiler itself is not reported.
+
+profileFunctions = ['Markdown_reader', 'clean_markdown', 'extract_links', 'justify_line']
+memFrames = 8 # Frames traced of each allocation, to find the function of this script
+memProfiler = ['mem_snapshot', 'add_mem_sites', 'mem_profiler', 'worker_memory', 'mem_site']
+
+
+class Profile_data:
+    #### Raw cProfile stats, in the shape that pstats.Stats loads
+    def __init__(this, stats):
+        this.stats = stats
+
+    def create_stats(this):
+        pass
+
+
+def mem_snapshot():
+    # Snapshot of the traced memory (the tracing starts with the first one)
+    if not tracemalloc.is_tracing():
+        script_functions() ## Before tracing, so reading this script is not traced
+        tracemalloc.start(memFrames)
+    return tracemalloc.take_snapshot()
+
+
+def add_mem_sites(before, after):
+    # Add the memory allocated (and not freed) between two snapshots by its site.
+    # The memory of tracemalloc (e.g. the snapshots) is filtered out before comparing
+    # them, and the one of the profiler by its site (see mem_site), as a filter of each
+    # of its lines would be checked against every trace. Only the later snapshot is
+    # filtered, as only the memory allocated is added
+    after = after.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    for diff in after.compare_to(before, 'traceback'):
+        if diff.size_diff > 0:
+            site = mem_site(diff.traceback)
+            if site:
+                memSites[site] += diff.size_diff
+
+
+@contextlib.contextmanager
+def mem_profiler(phase):
+    # Memory allocated (and not freed) during a phase, and its peak (see --profile mem)
+    if profileMode != "mem":
+        yield
+        return
+    before = mem_snapshot()
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        memPeaks[phase] = max(memPeaks.get(phase, 0), tracemalloc.get_traced_memory()[1])
+        add_mem_sites(before, mem_snapshot())
+
+
+def worker_memory():
+    # At the exit of a worker (see convert_page), its memory allocated and not freed
+    # since its first page is written for the main process (see save_profile)
+    memSites.clear()
+    add_mem_sites(memSnapshot, mem_snapshot())
+    try:
+        with open("%s-%d.mem" % (profileName, os.getpid()), 'wt') as fl:
+            json.dump([[name, lineno, size] for (name, lineno), size in memSites.items()], fl)
+    except OSError as e:
+        error(e, " while writing the memory profile of a worker")
+
+
+@functools.lru_cache(maxsize=None)
+def script_functions():
+    # (first line, last line, name) of the functions and classes of this script
+    functions = []
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.ClassDef)):
+                name = prefix + child.name
+                functions.append((child.lineno, child.end_lineno, name))
+                visit(child, name + '.')
+            else:
+                visit(child, prefix)
+    try:
+        with open(__file__, 'rt') as fl:
+            visit(ast.parse(fl.read()), '')
+    except (OSError, SyntaxError) as e:
+        warn(e, " while reading ", __file__)
+    return functions
+
+
+@functools.lru_cache(maxsize=None)
+def script_function(lineno):
+    # Innermost function (or class) of this script that has the line
+    name = '<module>'
+    size = None
+    for first, last, function in script_functions():
+        if first <= lineno <= last and (size is None or last - first < size):
+            name = function
+            size = last - first
+    return name
+
+
+def mem_site(traceback):
+    # Function and line of this script (the most recent frame) that allocated the memory,
+    # or None when it is the profiler (memProfiler functions)
+    for frame in reversed(traceback):
+        if frame.filename == __file__:
+            name = script_function(frame.lineno)
+            return None if name in memProfiler else (name, frame.lineno)
+    return ('<other>', 0)
+
+
+def collapsed_stacks(stats, limit = 64):
+    # Stacks of the raw cProfile stats as "caller;callee count" lines (in microseconds),
+    # following the calls from the root functions, and splitting the time of each
+    # function among its callers in proportion to the time of each call edge
+    def label(function):
+        filename, lineno, name = function
+        return name + ' (' + os.path.basename(filename) + ':' + str(lineno) + ')'
+
+    callees = collections.defaultdict(list)
+    for function, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller].append((function, edge[3]))
+    lines = collections.Counter()
+
+    def visit(function, path, fraction):
+        cc, nc, tt, ct, callers = stats[function]
+        path = path + [label(function)]
+        lines[';'.join(path)] += tt * fraction
+        if len(path) >= limit:
+            return
+        for callee, edgeTime in callees[function]:
+            calleeTime = stats[callee][3]
+            if calleeTime <= 0 or label(callee) in path:
+                continue
+            share = fraction * min(edgeTime / calleeTime, 1.0)
+            if share * calleeTime >= 1e-6:
+                visit(callee, path, share)
+
+    for function, (cc, nc, tt, ct, callers) in stats.items():
+        if not callers:
+            visit(function, [], 1.0)
+    return [stack + ' ' + str(int(round(seconds * 1e6)))
+            for stack, seconds in lines.items() if seconds >= 0.5e-6]
+
+
+def save_profile():
+    # Write the profile files of the run
+    profiles = [Profile_data(stats) for stats in cpuProfiles if stats]
+    if profileMode == "cpu" and not profiles:
+        warn("Nothing was profiled")
+    elif profileMode == "cpu":
+        stats = pstats.Stats(*profiles) ## Merged
+        stats.dump_stats(profileName + ".pstats")
+        with open(profileName + ".collapsed", 'wt') as fl:
+            for line in collapsed_stacks(stats.stats):
+                fl.write(line + '\n')
+        print("CPU profile written to", profileName + ".pstats and", profileName + ".collapsed")
+        stats.sort_stats('cumulative').print_stats(15)
+    elif profileMode == "mem":
+        for name in glob.glob(glob.escape(profileName) + "-*.mem"): ## Of the workers (see worker_memory)
+            try:
+                with open(name, 'rt') as fl:
+                    memSites.update({(site, lineno): size for site, lineno, size in json.load(fl)})
+                os.remove(name)
+            except (OSError, ValueError) as e:
+                warn(e, " while reading the memory profile ", name)
+        lines = ["Peak of traced memory by phase (KiB):"]
+        for phase, peak in memPeaks.items():
+            lines.append("    %-28s %10.1f" % (phase, peak / 1024))
+        for function in profileFunctions + [None]:
+            sites = [(size, site) for site, size in memSites.items() if function is None or
+                    site[0] == function or site[0].startswith(function + '.')]
+            lines.append("\nTop allocating sites " + ("in " + function if function else "overall") +
+                    " (KiB allocated and not freed at the end of each phase or worker):")
+            for size, (name, lineno) in sorted(sites, reverse = True)[:10]:
+                lines.append("    %10.1f  %s (line %d)" % (size / 1024, name, lineno))
+        with open(profileName + ".txt", 'wt') as fl:
+            fl.write('\n'.join(lines) + '\n')
+        print('\n'.join(lines))
+        print("Memory profile written to", profileName + ".txt")
+
+
+@page_timer
+def convert_file(kind, src, dst, arPath, arLast, arBase):
+    # Convert a page (see convert_cached), keeping its internal links (see
+    # check_links) and its words (see update_search_index)
+    links = siteLinks.setdefault((kind, dst), [])
+    key, reused = convert_cached(kind, src, dst, arPath, arLast, arBase, links)
+    if searchIndex and os.path.isfile(dst):
+        try:
+            with open(dst, 'rb') as fl:
+                siteTerms[(kind, dst)] = ggsearch.page_terms(fl.read(), kind == 'gemini')
+        except OSError as e:
+            error(e, " while indexing ", dst)
+    return key, reused
+
+
+def convert_cached(kind, src, dst, arPath, arLast, arBase, links):
+    # Convert a page, reusing the output of a previous build when neither the
+    # page nor the options changed (see --cache).
+    # Returns the cache key of the page (or None) and whether it was reused
+    convert = convert_gopher if kind == 'gopher' else convert_gemini
+    if not cacheFolder:
+        convert(src, dst, arPath, arLast, arBase, links)
+        return None, False
+    try:
+        with open(src, 'rb') as fl:
+            data = fl.read()
+    except OSError as e:
+        error(e, " while reading file ", src)
+        return None, False
+    if b'copyPage:true' in data.split(b'\n', 1)[0]:
+        # The output of this page comes from the last build folder
+        convert(src, dst, arPath, arLast, arBase, links)
+        return None, False
+
+    key = hashlib.sha256('\0'.join([cacheSeed, kind, arBase, '']).encode() + data).hexdigest()
+    cached = cache_name(key)
+    try:
+        if os.path.isfile(cached):
+            vbprint("REUSE:", cached, "->", dst)
+            with open(cached, 'rb') as fl:
+                write_page(dst, fl.read())
+            try:
+                with open(cached + ".links", 'rt') as fl:
+                    links += json.load(fl)
+            except (OSError, ValueError) as e:
+                warn(e, " while reading the links of ", cached)
+            delete_file(src)
+            return key, True
+        convert(src, dst, arPath, arLast, arBase, links)
+        if os.path.isfile(dst):
+            os.makedirs(os.path.dirname(cached), exist_ok = True)
+            with open(cached + ".links-" + str(os.getpid()), 'wt') as fl:
+                json.dump(links, fl)
+            os.replace(cached + ".links-" + str(os.getpid()), cached + ".links")
+            shutil.copyfile(dst, cached + "-" + str(os.getpid()))
+            os.replace(cached + "-" + str(os.getpid()), cached)
+    except OSError as e:
+        error(e, " while using the build cache for ", src, "=>", dst)
+    return key, False
+
+
+def record_page(kind, name, key, reused):
+    # Keep track of the converted pages for the build cache manifest
+    global reusedPages
+    if key:
+        buildManifest[kind][name] = key
+    if reused:
+        reusedPages += 1
+
+
+def convert_page(kind, src, dst, arPath, arLast, arBase, options):
+    # Convert one page in a worker process (see --jobs).
+    # The stdout and stderr output of the conversion is captured and returned,
+    # so the parent can print it (in order) together with the rest of the run
+    # (and so are the run metrics and the profile of the page).
+    # The options of the page are set when they are not the ones of the last
+    # page (the pool is shared by the sites of a batch, see batch_sites)
+    global memSnapshot
+    if options != get_options():
+        set_options(options)
+    out = io.StringIO()
+    err = io.StringIO()
+    runCounters.clear()
+    del pageTimes[:]
+    siteLinks.clear()
+    siteTerms.clear()
+    memSites.clear()
+    memPeaks.clear()
+    profiler = cProfile.Profile() if profileMode == "cpu" else None
+    if profileMode == "mem" and memSnapshot is None: ## Once per worker (see worker_memory)
+        memSnapshot = mem_snapshot()
+        multiprocessing.util.Finalize(None, worker_memory, exitpriority = 0)
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        if profiler:
+            profiler.enable()
+        key, reused = convert_file(kind, src, dst, arPath, arLast, arBase)
+        if profiler:
+            profiler.disable()
+            profiler.create_stats()
+    if profileMode == "mem":
+        memPeaks['convert ' + kind] = tracemalloc.get_traced_memory()[1]
+    return key, reused, out.getvalue(), err.getvalue(), (runCounters, pageTimes, siteLinks,
+            siteTerms, profiler.stats if profiler else None, memSites, memPeaks)
+
+
+def traverse_gemini(index, arGemini, arPath, arLast, arBase, pool = None):
+    # When a pool is given the conversions are submitted to it, and
+    # the list of (kind, name, future) is returned (see wait_conversions)
  
     count = 0
+    futures = []
+    options = get_options() if pool else None
  
     print("\nGemini phase -- preparing capsule\n")
 
     # Get a list of all files in the gemini capsule
-    for rootDir, subdirs, filenames in os.walk(arGemini):
+    for rootDir, subdirs, filenames in index.walk(arGemini):
         # process each file
         for filename in filenames:
             try:
@@ -1009,26 +2082,38 @@ def traverse_gemini(arGemini, arPath, arLast, arBase):
                     os.rename(sourceName, sourceName + "-old")
                     folder = os.path.dirname(rootDir)
                     if folder == arPath:
-                        convert_gemini(sourceName + "-old", os.path.join(rootDir, 
-                            base + ".gmi"), arPath, arLast, arBase)
+                        target = os.path.join(rootDir, base + ".gmi")
+                    else:
+                        target = os.path.join(folder, base + ".gmi")
+                    name = os.path.relpath(sourceName, arPath)
+                    index.remove(sourceName)
+                    index.add(target)
+                    if pool:
+                        futures.append(('gemini', name, pool.submit(convert_page, 'gemini',
+                            sourceName + "-old", target, arPath, arLast, arBase, options)))
                     else:
-                        convert_gemini(sourceName + "-old", os.path.join(folder, 
-                            base + ".gmi"), arPath, arLast, arBase)
+                        record_page('gemini', name, *convert_file('gemini',
+                            sourceName + "-old", target, arPath, arLast, arBase))
 
             except OSError as e:
                 error(e," while processing gemini file", filename)
 
     print("Number of gemini capsule files", count)
+    return futures
 
 
-def traverse_gopher(arGopher, arPath, arLast, arBase):
+def traverse_gopher(index, arGopher, arPath, arLast, arBase, pool = None):
+    # When a pool is given the conversions are submitted to it, and
+    # the list of (kind, name, future) is returned (see wait_conversions)
  
     count = 0
+    futures = []
+    options = get_options() if pool else None
  
     print("\nGopher phase -- digging hole\n")
 
     # Get a list of all files in the gopher hole
-    for rootDir, subdirs, filenames in os.walk(arGopher):
+    for rootDir, subdirs, filenames in index.walk(arGopher):
         # process each file
         for filename in filenames:
             try:
@@ -1040,26 +2125,64 @@ def traverse_gopher(arGopher, arPath, arLast, arBase):
 
                 if filename.lower() == "gophermap.txt":
                     count += 1
-                    convert_gopher(sourceName, os.path.join(rootDir, "gophermap"), 
-                            arPath, arLast, arBase)
+                    name = os.path.relpath(sourceName, arPath)
+                    index.remove(sourceName)
+                    index.add(os.path.join(rootDir, "gophermap"))
+                    if pool:
+                        futures.append(('gopher', name, pool.submit(convert_page, 'gopher',
+                            sourceName, os.path.join(rootDir, "gophermap"),
+                            arPath, arLast, arBase, options)))
+                    else:
+                        record_page('gopher', name, *convert_file('gopher', sourceName,
+                            os.path.join(rootDir, "gophermap"), arPath, arLast, arBase))
 
             except OSError as e:
                 error(e," while processing gopher file", filename)
 
     print("Number of gopher hole files", count)
-
-
-def traverse_site(arPath, arGopher, typeGopher, arGemini, typeGemini):
+    return futures
+
+
+def wait_conversions(futures):
+    # Wait for the conversions submitted to the pool, printing the
+    # output of each page in the order the pages were submitted
+    for kind, name, future in futures:
+        key, reused, out, err, (counters, times, links, terms, cpu, sites, peaks) = future.result()
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        runCounters.update(counters)
+        pageTimes.extend(times)
+        siteLinks.update(links)
+        siteTerms.update(terms)
+        if cpu:
+            cpuProfiles.append(cpu)
+        memSites.update(sites)
+        for phase, peak in peaks.items():
+            memPeaks[phase] = max(memPeaks.get(phase, 0), peak)
+        record_page(kind, name, key, reused)
+
+
+def traverse_site(index, arPath, arGopher, typeGopher, arGemini, typeGemini):
  
     count = 0
-    lenArGopher = len(arGopher)
-    lenArGemini = len(arGemini)
     oldFiles = []
+    movedFolders = {}
+    # The static files are cloned by a pool of threads (as cloning is mostly waiting
+    # for the file system), which create each destination folder only once
+    clones = []
+    folders = set()
+    cloner = concurrent.futures.ThreadPoolExecutor(cloneThreads)
+    cloned = runCounters['bytes cloned']
+    skipped = runCounters['bytes skipped']
+    linked = runCounters['files linked']
+    start = time.perf_counter()
 
     print("Prepare phase\n")
  
-    # Get a list of all files in the site
-    for rootDir, subdirs, filenames in os.walk(arPath):
+    # Get a list of all files in the site.
+    # Files under arGopher or arGemini are in the right directory structure,
+    # and they are processed in the gopher and gemini phases
+    for rootDir, subdirs, filenames in index.walk(arPath, 'site'):
         try:
             for filename in filenames:
                 vbprint("SOURCE: rootDir='",rootDir,"', subDirs=",
@@ -1074,17 +2197,7 @@ def traverse_site(arPath, arGopher, typeGopher, arGemini, typeGemini):
                 name, ext = os.path.splitext(filename)
                 base = os.path.basename(rootDir)
 
-                ## B) Files in the right directory
-                ## Process gopher or gemini files that are in the right directory structure
-                ## Meaning files that are under the correct arGopher or arGemini directory
-                if (((len(rootDir) >= lenArGopher) and (rootDir[0:lenArGopher] == arGopher))
-                        or ((len(rootDir) >= lenArGemini)
-                            and (rootDir[0:lenArGemini] == arGemini))):
-                    vbprint("=>",rootDir, ":", [arGopher, arGemini])
-
-                    continue
-
-                ## C) Files in the wrong directory
+                ## B) Files in the wrong directory
                 ## process file that need to be clone into the arGopher or arGemini directory structure 
                 count += 1
                 # root is the original path without the site directory arPath
@@ -1094,35 +2207,81 @@ def traverse_site(arPath, arGopher, typeGopher, arGemini, typeGemini):
                 if base in ["gopher", "gemini"]:
                     root = clean_dir(root.replace(os.sep + base,"",1))
 
+                targets = []
                 if base == "gopher" and typeGopher:
-                    clone_file(sourceName,os.path.join(arGopher,root,filename))
-                    oldFiles.append(sourceName)
+                    targets.append(os.path.join(arGopher,root,filename))
                 if base == "gemini" and typeGemini:
-                    clone_file(sourceName,os.path.join(arGemini,root,filename))
-                    oldFiles.append(sourceName)
+                    targets.append(os.path.join(arGemini,root,filename))
 
-                ## D) Files that come from the Hugo's static directory
+                ## C) Files that come from the Hugo's static directory
                 if not (base in ["gopher", "gemini"]):
                     if typeGopher:
-                        clone_file(sourceName,os.path.join(arGopher,root,filename))
+                        targets.append(os.path.join(arGopher,root,filename))
                     if typeGemini:
-                        clone_file(sourceName,os.path.join(arGemini,root,filename))
+                        targets.append(os.path.join(arGemini,root,filename))
+
+                for target in targets:
+                    index.add(target)
+                if targets:
+                    clones.append((rootDir, sourceName,
+                        cloner.submit(clone_static, sourceName, targets, folders)))
+                elif not (base in ["gopher", "gemini"]):
                     oldFiles.append(sourceName)
+                index.remove(sourceName)
 
         except OSError as e:
             error(e," while processing file", filename)
 
+    for rootDir, sourceName, future in clones:
+        if future.result():
+            movedFolders[rootDir] = None
+        else:
+            oldFiles.append(sourceName)
+    cloner.shutdown()
     for fl in oldFiles:
         delete_file(fl)
+    for folder in movedFolders:
+        try:
+            remove_empty_folders(folder)
+        except OSError as e:
+            warn(e, "deleting ",folder)
     print("Number of cloned files", count)
+    seconds = time.perf_counter() - start
+    cloned = runCounters['bytes cloned'] - cloned
+    print("Cloned", round(cloned / 1e6, 2), "MB in", round(seconds, 3), "seconds (",
+            round(cloned / 1e6 / seconds, 2) if seconds else 0, "MB/s ),",
+            round((runCounters['bytes skipped'] - skipped) / 1e6, 2), "MB skipped as unchanged")
+    linked = runCounters['files linked'] - linked
+    if linked:
+        print("Moved or hardlinked", linked, "files")
+
+
+def merge_folder(index, src, dst):
+    # Move the content of the folder src into the folder dst, renaming whole
+    # subtrees, and merging only the folders that are in both
+    with os.scandir(src) as entries:
+        entries = list(entries)
+    for entry in entries:
+        target = os.path.join(dst, entry.name)
+        if entry.is_dir(follow_symlinks = False) and os.path.isdir(target) and not os.path.islink(target):
+            merge_folder(index, entry.path, target)
+        else:
+            vbprint("MOVE:", entry.path, "->", target)
+            os.replace(entry.path, target)
+            index.move(entry.path, target)
+    os.rmdir(src)
+    index.move(src, dst)
 
 
-def fix_hugo_nested_paths(arPath, arGemini, arGopher):
+def fix_hugo_nested_paths(index, arPath, arGemini, arGopher):
     #
     # Sometimes hugo generates nested paths
     # It happens in "test-hugo-theme-console", 
     #    where "public-gg/gemini/gemini" and "public-gg/gopher/gemini" are generated
-    # So, this is a kludge to fix that hugo behaviour
+    # So, this is a kludge to fix that hugo behaviour.
+    # It runs before the conversion, so the nested folders are merged into
+    # their parent with a rename for each subtree (instead of moving each file),
+    # and the pages are converted where they belong
     geminiPath = arGemini.replace(arPath + os.sep, "", 1)
     gopherPath = arGopher.replace(arPath + os.sep, "", 1)
     badPath = [os.path.join(arPath, geminiPath, geminiPath), 
@@ -1130,34 +2289,662 @@ def fix_hugo_nested_paths(arPath, arGemini, arGopher):
                os.path.join(arPath, gopherPath, geminiPath), 
                os.path.join(arPath, gopherPath, gopherPath)] 
     for path in badPath:
-        if not os.path.isdir(path):
+        if not os.path.isdir(path) or os.path.islink(path):
             continue
         vbprint("Fixing hugo generated nested path", path)
         if path.endswith(os.sep + geminiPath):
             goodPath = path[:-len(os.sep + geminiPath)]
         elif path.endswith(os.sep + gopherPath):
             goodPath = path[:-len(os.sep + gopherPath)]
-        isGemini = path.startswith(arGemini)
-        for rootDir, subdirs, filenames in os.walk(path):
-            try:
-                for filename in filenames:
-                    sourceName = os.path.join(rootDir, filename)
-                    if isGemini:
-                        targetName = os.path.join(os.path.dirname(rootDir),
-                                filename).replace(path, goodPath, 1)
-                    else:
-                        targetName = sourceName.replace(path, goodPath, 1)
-                    clone_file(sourceName, targetName)
-                    delete_file(sourceName)
+        try:
+            merge_folder(index, path, goodPath)
+        except OSError as e:
+            error(e," while fixing the nested path", path)
+
 
+def output_paths(index, top):
+    # Hash index of the selectors (or paths) of the files, and of the folders
+    # with files, under top. Each one is relative to top, starting with '/'
+    paths = {'/'}
+    for rootDir, subdirs, filenames in index.walk(top):
+        if not filenames:
+            continue
+        folder = '/' + os.path.relpath(rootDir, top).replace(os.sep, '/')
+        folder = '/' if folder == '/.' else folder
+        for filename in filenames:
+            paths.add(posixpath.join(folder, filename))
+        while not folder in paths:
+            paths.add(folder)
+            folder = posixpath.dirname(folder)
+    return paths
+
+
+def dead_link(link, paths, arBase, isGemini):
+    # Answer the question: does an internal link miss its target in paths?
+    if arBase and (link == arBase or link.startswith(arBase.rstrip('/') + '/')):
+        link = link[len(arBase.rstrip('/')):] or '/'
+    if isGemini:
+        link = urllib.parse.unquote(link.split('#', 1)[0].split('?', 1)[0])
+    link = link.rstrip('/') or '/'
+    return not link in paths
+
+
+def check_links(index, arGopher, arGemini, arBaseGopher, arBaseGemini):
+    # Check the internal links of the converted pages (see siteLinks) against
+    # the files of the site, and report the links whose target does not exist.
+    # A partial index (in watch mode) only has the changed files, so the site
+    # is scanned again
+    if not siteLinks:
+        return
+    if index.partial:
+        index = Site_index(index.arPath, arGopher, arGemini)
+    count = 0
+    for kind, top, arBase in (('gopher', arGopher, arBaseGopher), ('gemini', arGemini, arBaseGemini)):
+        pages = sorted((page, links) for (pageKind, page), links in siteLinks.items() if pageKind == kind)
+        if not pages:
+            continue
+        paths = output_paths(index, top)
+        for page, links in pages:
+            for link in sorted(set(links)):
+                if dead_link(link, paths, arBase, kind == 'gemini'):
+                    count += 1
+                    warn("Dead link '", link, "' in ", kind, " page '", page, "'")
+    print("Number of dead links", count)
+    runCounters['dead links'] += count
+    siteLinks.clear()
+
+
+##  Search index (--index) ##
+##
+## The title and the words of each converted page (see convert_file) are
+## written to a search index (searchIndexName) in the gopher and gemini folders.
+## It is an inverted index (word -> pages) that ggsearch.py looks up from the
+## mapped file, as a gopher type 7 or a gemini CGI program (and so does the
+## preview server at searchSelector). See ggsearch.py for the file format.
+
+def page_selector(kind, top, page):
+    # Selector (or path) of a converted page, relative to top
+    selector = '/' + os.path.relpath(page, top).replace(os.sep, '/')
+    if kind == 'gopher':
+        selector = posixpath.dirname(selector).rstrip('/') + '/'
+    return selector
+
+
+def selector_page(kind, top, selector):
+    # File name of the page of a selector (see page_selector)
+    name = os.path.join(top, *[part for part in selector.split('/') if part])
+    return os.path.join(name, "gophermap") if kind == 'gopher' else name
+
+
+def update_search_index(index, arGopher, arGemini, arBaseGopher, arBaseGemini):
+    # Write the search index of each kind of converted pages. A partial index (in
+    # watch mode) only has the changed pages, so they replace theirs in the last
+    # index written (read once), and the pages whose file is gone are dropped
+    for kind, top, arBase in (('gopher', arGopher, arBaseGopher), ('gemini', arGemini, arBaseGemini)):
+        pages = {page_selector(kind, top, page): terms
+                for (pageKind, page), terms in siteTerms.items() if pageKind == kind}
+        if not pages:
+            continue
+        name = os.path.join(top, searchIndexName)
+        if index.partial:
+            if not name in searchPages and os.path.isfile(name):
+                try:
+                    with ggsearch.Search_index(name) as last:
+                        searchPages[name] = last.pages()
+                except (OSError, ValueError) as e:
+                    warn(e, " while reading the search index ", name)
+            last = searchPages.get(name, {})
+            last.update(pages)
+            pages = {selector: terms for selector, terms in last.items()
+                    if os.path.isfile(selector_page(kind, top, selector))}
+        searchPages[name] = pages
+        try:
+            size = ggsearch.write_index(name, pages, arBase.rstrip('/'))
+            index.add(name)
+            print("Number of", kind, "pages in the search index", len(pages), "(" + str(size), "bytes)")
+        except OSError as e:
+            error(e, " while writing the search index ", name)
+    siteTerms.clear()
+
+
+assetDigests = {} # file name -> (mtime_ns, size, inode, sha256) of the static files (see dedupe_assets)
+
+def asset_digest(name, st):
+    # Hash of the content of a static file (kept while the file does not change)
+    cached = assetDigests.get(name)
+    if cached and cached[:3] == (st.st_mtime_ns, st.st_size, st.st_ino):
+        return cached[3]
+    digest = hashlib.sha256()
+    with open(name, 'rb') as fl:
+        for block in iter(lambda: fl.read(1 << 20), b''):
+            digest.update(block)
+    assetDigests[name] = (st.st_mtime_ns, st.st_size, st.st_ino, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def dedupe_assets(index, arGopher, arGemini):
+    # Keep one copy of each static file content in the gopher and gemini folders,
+    # replacing the rest by hard links to it. Only files of the same size are hashed.
+    # The converted pages are not linked, as they are replaced on each build.
+    # A deploy that does not preserve hard links just copies the content
+    if index.partial: ## Only the changed files (see watch_site)
+        index = Site_index(index.arPath, arGopher, arGemini)
+    sizes = {}
+    for top in (arGopher, arGemini):
+        for rootDir, subdirs, filenames in index.walk(top):
+            for filename in filenames:
+                if filename == "gophermap" or filename.endswith(".gmi"):
+                    continue
+                name = os.path.join(rootDir, filename)
+                try:
+                    st = os.stat(name)
+                except OSError:
+                    continue
+                if st.st_size:
+                    sizes.setdefault(st.st_size, []).append((name, st))
+    count = 0
+    saved = 0
+    for size, files in sizes.items():
+        if len(files) < 2:
+            continue
+        blobs = {} # sha256 -> (name, stat) of the copy that is kept
+        for name, st in files:
+            try:
+                first, firstSt = blobs.setdefault(asset_digest(name, st), (name, st))
+                if first == name or (firstSt.st_dev, firstSt.st_ino) == (st.st_dev, st.st_ino):
+                    continue
+                vbprint("DEDUPE:", name, "->", first)
+                os.link(first, name + "-new")
+                os.replace(name + "-new", name)
+                count += 1
+                saved += size
             except OSError as e:
-                error(e," while processing file", filename)
+                vbprint("DEDUPE:", e) ## e.g. across file systems, the copy is kept
+                if os.path.lexists(name + "-new"):
+                    os.remove(name + "-new")
+    print("Number of deduplicated files", count, "(" + str(saved), "bytes saved)")
+
+
+def convert_site(index, arPath, arGopher, typeGopher, arGemini, typeGemini,
+        arLast, arBaseGopher, arBaseGemini, pool = None):
+    # Run all the phases over the files of the index
+
+    #### For some unknown reason to me, sometimes hugo generates nested folders as follows:
+    ####     public-gg/gemini/gemini/...
+    ####     public-gg/gopher/gemini/...
+    ####     public-gg/gopher/gopher/...
+    ####     public-gg/gemini/gopher/...
+    #### Don't understand why hugo do that, but it needs to be fixed, so
+    with phase_timer('fix_hugo_nested_paths'):
+        fix_hugo_nested_paths(index, arPath, arGemini, arGopher)
+
+    with phase_timer('traverse_site'):
+        traverse_site(index, arPath, arGopher, typeGopher, arGemini, typeGemini)
+    futures = []
+    if typeGopher:
+        with phase_timer('traverse_gopher'):
+            futures += traverse_gopher(index, arGopher, arPath, arLast, arBaseGopher, pool)
+    if typeGemini:
+        with phase_timer('traverse_gemini'):
+            futures += traverse_gemini(index, arGemini, arPath, arLast, arBaseGemini, pool)
+    if pool:
+        with phase_timer('wait_conversions'):
+            wait_conversions(futures)
+    if cacheFolder:
+        with phase_timer('save_build_cache'):
+            save_build_cache()
+        print("Number of pages reused from cache", reusedPages)
+
+    if dedupeAssets:
+        with phase_timer('dedupe_assets'):
+            dedupe_assets(index, arGopher, arGemini)
+
+    with phase_timer('check_links'):
+        check_links(index, arGopher, arGemini, arBaseGopher, arBaseGemini)
+
+    if searchIndex:
+        with phase_timer('update_search_index'):
+            update_search_index(index, arGopher, arGemini, arBaseGopher, arBaseGemini)
+
+
+def run_stats(wall, cpu):
+    # Metrics of the run (see --stats), as a json document
+    pages = {}
+    for pageWall, pageCpu, kind, page in pageTimes:
+        totals = pages.setdefault(kind, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+        totals['count'] += 1
+        totals['wall'] += pageWall
+        totals['cpu'] += pageCpu
+    slowest = sorted(pageTimes, key = lambda times: times[0], reverse = True)[:statsSlowest]
+    counters = {'pages reused': reusedPages}
+    warnings = {}
+    errors = {}
+    for name, count in sorted(runCounters.items()):
+        if name.startswith('warning: '):
+            warnings[name[9:]] = count
+        elif name.startswith('error: '):
+            errors[name[7:]] = count
+        else:
+            counters[name] = count
+    stats = {
+        'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'wall': wall,
+        'cpu': cpu, ## Of the main process (see pages for the cpu time of the conversions)
+        'phases': {phase: {'wall': times[0], 'cpu': times[1]} for phase, times in phaseTimes.items()},
+        'pages': pages,
+        'slowest': [{'page': page, 'kind': kind, 'wall': pageWall, 'cpu': pageCpu}
+            for pageWall, pageCpu, kind, page in slowest],
+        'counters': counters,
+        'warnings': warnings,
+        'errors': errors,
+    }
+    return stats
+
+
+def save_stats(stats):
+    try:
+        with open(statsFile, 'wt') as fl:
+            json.dump(stats, fl, indent = 1)
+    except OSError as e:
+        error(e, " while writing the stats ", statsFile)
+
+
+def scan_mtimes(arPath):
+    # Modification time and size of each file of the site (see watch_site)
+    stats = {}
+    folders = [arPath]
+    while folders:
+        rootDir = folders.pop()
+        try:
+            with os.scandir(rootDir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks = False):
+                            folders.append(entry.path)
+                        elif not entry.name.endswith(("-new", "-old")): ## Our temporary files
+                            st = entry.stat()
+                            stats[entry.path] = (st.st_mtime_ns, st.st_size)
+                    except OSError:
+                        pass ## Removed while scanning
+        except OSError as e:
+            vbprint("WATCH:", e)
+    return stats
+
+
+def watch_site(hugo, arPath, arGopher, typeGopher, arGemini, typeGemini,
+        arLast, arBaseGopher, arBaseGemini, pool = None):
+    # Keep converting the pages (and cloning the static files) that hugo writes
+    # in watch mode, until hugo ends or Ctrl+C is pressed.
+    # The site is scanned every watchInterval seconds, and only the files that
+    # changed go through the phases. A file is processed once it did not change
+    # between two scans, so files that hugo is still writing are not converted
+    print("\nWatching", arPath, "for changes (press Ctrl+C to stop)")
+    seen = scan_mtimes(arPath)
+    pending = {}
+    while (hugo is None) or (hugo.poll() is None):
+        time.sleep(watchInterval)
+        stats = scan_mtimes(arPath)
+        seen = {name: stat for name, stat in seen.items() if name in stats}
+        changed = {name: stat for name, stat in stats.items() if seen.get(name) != stat}
+        ready = [name for name, stat in changed.items() if pending.get(name) == stat]
+        pending = changed
+        if not ready:
+            continue
+
+        start = time.time()
+        print("\nChanged files:", len(ready))
+        index = Site_index(arPath, arGopher, arGemini, ready)
+        convert_site(index, arPath, arGopher, typeGopher, arGemini, typeGemini,
+                arLast, arBaseGopher, arBaseGemini, pool)
+        # The files written by the phases are not changes to process
+        for name in ready + list(index.files()):
+            pending.pop(name, None)
+            try:
+                st = os.stat(name)
+                seen[name] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                seen.pop(name, None)
+        print("Changes processed in", round(time.time() - start, 3), "seconds")
+    error("Hugo watch ended with", hugo.returncode)
+
+
+##  Preview server (--serve) ##
+##
+## A gopher server (plain TCP) and a gemini server (TLS) on the output folders,
+## to check a build without deploying it. The gophermaps and the .gmi pages are
+## kept in memory (the gophermaps already rendered as gopher menus), and each
+## one is read again when the size or the modification time of its file changes.
+## Both servers run in an asyncio event loop in a thread, so they can run while
+## watching the site (see watch_site). When there is a search index (see --index)
+## the searchSelector is a search (a type 7 selector, or a gemini input).
+
+serveCache = {} # file name -> (mtime_ns, size, content)
+
+def cached_page(name, render):
+    # Content of a gophermap or .gmi page, reading it only when it changed.
+    # Raises OSError when it can not be read
+    st = os.stat(name)
+    cached = serveCache.get(name)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    with open(name, 'rb') as fl:
+        content = render(fl.read())
+    serveCache[name] = (st.st_mtime_ns, st.st_size, content)
+    return content
+
+
+def read_file(name):
+    with open(name, 'rb') as fl:
+        return fl.read()
+
+
+def served_file(root, path):
+    # Full name of path (a selector or a url path) under root, or None when
+    # it would escape root
+    name = os.path.normpath(os.path.join(root, *[part for part in path.split('/') if part]))
+    if name != root and not name.startswith(os.path.join(root, '')):
+        return None
+    return name
+
+
+def gopher_menu(data, selector):
+    # Render a gophermap as a gopher menu (as gophernicus or pygopherd do): lines
+    # without a tab are text, and the missing fields of the rest are filled in
+    folder = selector.rstrip('/')
+    lines = []
+    for line in data.decode('utf-8', 'replace').splitlines():
+        if not '\t' in line:
+            lines.append('i' + line + '\t\t' + serveHost + '\t' + str(serveGopherPort))
+            continue
+        fields = line.split('\t')
+        fields += [''] * (4 - len(fields))
+        if not fields[1].startswith(('/', 'URL:')) and fields[0][0:1] != 'i':
+            fields[1] = folder + '/' + fields[1]
+        fields[2] = fields[2] or serveHost
+        fields[3] = fields[3] or str(serveGopherPort)
+        lines.append('\t'.join(fields[:4]))
+    return ('\r\n'.join(lines) + '\r\n.\r\n').encode()
+
+
+def folder_list(name, path, gemini):
+    # Menu (or gemini page) of a folder without gophermap (or index.gmi)
+    lines = []
+    path = path.rstrip('/')
+    for entry in sorted(os.scandir(name), key = lambda entry: entry.name):
+        if entry.is_dir():
+            item = '1'
+        else:
+            item = item_type(path + '/' + entry.name, '9')
+        if gemini:
+            lines.append('=> ' + urllib.parse.quote(path + '/' + entry.name) + ' ' + entry.name)
+        else:
+            lines.append(item + entry.name + '\t' + path + '/' + entry.name + '\t' + serveHost
+                    + '\t' + str(serveGopherPort))
+    if gemini:
+        return ('\n'.join(['# ' + (path or '/'), ''] + lines) + '\n').encode()
+    return ('\r\n'.join(lines) + '\r\n.\r\n').encode()
+
+
+def search_site(name, query, gemini):
+    # Response of a search of the preview servers (see ggsearch.py)
+    with ggsearch.Search_index(name) as index:
+        total, results = index.search(query, searchLimit)
+    if gemini:
+        return ('20 text/gemini\r\n' + ggsearch.gemini_results(query, total, results)).encode()
+    return ggsearch.gopher_results(query, total, results, serveHost, serveGopherPort).encode()
+
+
+async def serve_gopher(reader, writer, arGopher):
+    loop = asyncio.get_running_loop()
+    try:
+        request = await asyncio.wait_for(reader.readline(), serveTimeout)
+        selector, tab, query = request.decode('utf-8', 'replace').strip('\r\n').partition('\t')
+        vbprint("GOPHER:", selector, query)
+        name = served_file(arGopher, urllib.parse.unquote(selector))
+        index = os.path.join(arGopher, searchIndexName)
+        if ggsearch and selector == searchSelector and os.path.isfile(index):
+            response = search_site(index, query, False)
+        elif name and os.path.isdir(name):
+            if os.path.isfile(os.path.join(name, 'gophermap')):
+                response = cached_page(os.path.join(name, 'gophermap'),
+                        lambda data: gopher_menu(data, selector))
+            else:
+                response = folder_list(name, selector, False)
+        elif name and os.path.isfile(name):
+            response = await loop.run_in_executor(None, read_file, name)
+        else:
+            response = ('3Not found: ' + selector + '\t\terror.host\t1\r\n.\r\n').encode()
+        writer.write(response)
+        await writer.drain()
+    except (OSError, ValueError, asyncio.TimeoutError) as e:
+        vbprint("GOPHER:", e)
+    finally:
+        writer.close()
+
+
+async def serve_gemini(reader, writer, arGemini):
+    loop = asyncio.get_running_loop()
+    try:
+        request = await asyncio.wait_for(reader.readline(), serveTimeout)
+        url = urllib.parse.urlsplit(request.decode('utf-8', 'replace').strip('\r\n'))
+        vbprint("GEMINI:", url.geturl())
+        path = urllib.parse.unquote(url.path) or '/'
+        name = served_file(arGemini, path)
+        index = os.path.join(arGemini, searchIndexName)
+        if len(request) > 1026 or url.scheme != 'gemini':
+            response = b'59 Bad request\r\n'
+        elif ggsearch and path == searchSelector and os.path.isfile(index):
+            if url.query:
+                response = search_site(index, urllib.parse.unquote(url.query), True)
+            else:
+                response = b'10 Search words\r\n'
+        elif name and os.path.isdir(name):
+            if os.path.isfile(os.path.join(name, 'index.gmi')):
+                response = b'20 text/gemini\r\n' + cached_page(os.path.join(name, 'index.gmi'),
+                        lambda data: data)
+            else:
+                response = b'20 text/gemini\r\n' + folder_list(name, path, True)
+        elif name and os.path.isfile(name) and name.endswith('.gmi'):
+            response = b'20 text/gemini\r\n' + cached_page(name, lambda data: data)
+        elif name and os.path.isfile(name):
+            mime = mimeTypes.guess_type(name)[0] or 'application/octet-stream'
+            response = ('20 ' + mime + '\r\n').encode() + await loop.run_in_executor(
+                    None, read_file, name)
+        else:
+            response = b'51 Not found\r\n'
+        writer.write(response)
+        await writer.drain()
+    except (OSError, ValueError, asyncio.TimeoutError) as e:
+        vbprint("GEMINI:", e)
+    finally:
+        writer.close()
+
+
+def serve_certificate():
+    # TLS certificate and key of the gemini server. The ssl module can only load
+    # them, so a self-signed certificate is created (once) with openssl
+    cert = serveCertificate + ".crt"
+    key = serveCertificate + ".key"
+    if os.path.isfile(cert) and os.path.isfile(key):
+        return cert, key
+    print("Creating a self-signed certificate for", serveHost, "in", cert)
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', key, '-out', cert, '-days', '3650', '-subj', '/CN=' + serveHost],
+            check = True, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        error(e, " while creating the certificate with openssl")
+        return None, None
+    return cert, key
+
+
+async def start_servers(arGopher, typeGopher, arGemini, typeGemini):
+    servers = []
+    if typeGopher:
+        try:
+            servers.append(await asyncio.start_server(
+                lambda reader, writer: serve_gopher(reader, writer, arGopher),
+                serveHost, serveGopherPort, limit = 4096))
+            print("Serving", arGopher, "at gopher://" + serveHost + ":" + str(serveGopherPort) + "/")
+        except OSError as e:
+            error(e, " while starting the gopher server")
+    if typeGemini:
+        cert, key = serve_certificate()
+        if cert:
+            try:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                context.load_cert_chain(cert, key)
+                servers.append(await asyncio.start_server(
+                    lambda reader, writer: serve_gemini(reader, writer, arGemini),
+                    serveHost, serveGeminiPort, ssl = context, limit = 4096))
+                print("Serving", arGemini, "at gemini://" + serveHost + ":" + str(serveGeminiPort) + "/")
+            except (OSError, ssl.SSLError) as e:
+                error(e, " while starting the gemini server")
+    return servers
+
+
+def serve_site(arGopher, typeGopher, arGemini, typeGemini):
+    # Start the servers in a thread, returning its event loop (or None when
+    # no server could start)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    servers = []
+
+    def run():
+        asyncio.set_event_loop(loop)
+        servers.extend(loop.run_until_complete(
+            start_servers(arGopher, typeGopher, arGemini, typeGemini)))
+        started.set()
+        if servers:
+            loop.run_forever()
+
+    threading.Thread(target = run, daemon = True).start()
+    started.wait()
+    return loop if servers else None
+
+
+##  Batch mode (--batch) ##
+##
+## A json manifest lists the sites (or the languages of a site) to convert, each
+## one as an object with its long flags (without the --), which are added to the
+## flags of the command line. For example:
+##
+##     [{"name": "blog", "path": "blog/public-gg", "base": "/blog", "type": "all"},
+##      {"path": "blog-es/public-gg", "config": "config-gg-es.toml", "type": "gemini"}]
+##
+## The gopher and gemini folders default to the ones under the path of the site.
+## The sites are converted one after the other by main, in this process, so they
+## share the parallel processes (which set the options of a page only when they
+## are not the ones of the last page), the map files read, and the compiled map
+## patterns and memoized lines of the sites with the same options.
+
+batchSettings = ['verbose', 'keepTmpFiles', 'fullGopherLine', 'gopherLineLength', 'textAlign', 'textSeed',
+        'maxEmptyLines', 'mapLinkLabels', 'mapReplace', 'mapItemTypes', 'cloneMethod',
+        'dedupeAssets', 'searchIndex', 'cacheFolder', 'cacheSeed', 'statsFile', 'profileMode']
+
+def manifest_sites(manifest):
+    # Name and flags of each site of a batch manifest
+    try:
+        with open(manifest, 'rt') as fl:
+            sites = json.load(fl)
+        if not isinstance(sites, list) or not sites:
+            raise ValueError("it is not a list of sites")
+    except (OSError, ValueError) as e:
+        error(e, " while reading the batch manifest ", manifest)
+        sys.exit(2)
+    flags = []
+    for number, site in enumerate(sites, 1):
+        if not isinstance(site, dict):
+            error("Site ", number, " of the batch manifest is not an object")
+            sys.exit(2)
+        site = dict(site)
+        if 'path' in site:
+            site.setdefault('gopher', os.path.join(site['path'], "gopher"))
+            site.setdefault('gemini', os.path.join(site['path'], "gemini"))
+        name = str(site.pop('name', site.get('path', number)))
+        argv = []
+        for flag, value in site.items():
+            if value is True:
+                argv.append('--' + flag)
+            elif not value is False and not value is None:
+                argv += ['--' + flag, str(value)]
+        try:
+            opts, args = getopt.getopt(argv, shortFlags, longFlags)
+        except getopt.GetoptError as e:
+            error(e, " in the site ", name, " of the batch manifest")
+            sys.exit(2)
+        for opt, arg in opts:
+            if opt in ("--watch", "--serve", "--jobs", "--batch", "--stats", "--profile", "--help"):
+                error(opt, " can not be used in the site ", name, " of the batch manifest")
+                sys.exit(2)
+        flags.append((name, argv))
+    return flags
+
+
+def batch_sites(manifest, argv, jobs):
+    # Convert the sites of a batch manifest, and report the results of each one
+    global reusedPages, buildManifest
+    for opt in argv:
+        if opt in ("-W", "--watch", "-s", "--serve"):
+            error(opt, " can not be used with --batch")
+            sys.exit(2)
+    sites = manifest_sites(manifest)
+    startWall = time.perf_counter()
+    settings = {name: globals()[name] for name in batchSettings}
+    pool = None
+    if jobs > 1:
+        print("Converting pages with", jobs, "processes")
+        pool = concurrent.futures.ProcessPoolExecutor(jobs,
+                initializer = set_options, initargs = (get_options(),))
+    reports = []
+    for name, flags in sites:
+        print("\n\nSite", name, "\n")
+        globals().update(settings)
+        runCounters.clear()
+        del pageTimes[:]
+        phaseTimes.clear()
+        siteLinks.clear()
+        siteTerms.clear()
+        buildManifest = {'gopher': {}, 'gemini': {}}
+        reusedPages = 0
+        try:
+            main(argv + flags, pool, reports)
+        except SystemExit as e: ## Invalid flags (see arguments)
+            error("Site ", name, " failed with ", e.code)
+            reports.append(None)
+        if reports[-1] is not None:
+            reports[-1]['site'] = name
+    if pool:
+        pool.shutdown()
+    globals().update(settings)
+
+    print("\nBatch of", len(sites), "sites done in", round(time.perf_counter() - startWall, 3), "seconds")
+    print("    %-30s %8s %8s %8s %8s %8s %9s" % ('Site', 'Pages', 'Reused', 'Dead', 'Warnings',
+        'Errors', 'Seconds'))
+    for (name, flags), report in zip(sites, reports):
+        if report is None:
+            print("    %-30s   FAILED" % name)
+            continue
+        print("    %-30s %8d %8d %8d %8d %8d %9.3f" % (name,
+            sum(kind['count'] for kind in report['pages'].values()), report['counters']['pages reused'],
+            report['counters'].get('dead links', 0), sum(report['warnings'].values()),
+            sum(report['errors'].values()), report['wall']))
+    if profileMode:
+        save_profile()
+    if statsFile:
+        save_stats({'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'wall': time.perf_counter() - startWall, 'sites': reports})
+        print("Stats written to", statsFile)
+
+
+def hugo_command(arPath, arConfig, arEmpty):
+    return ['hugo', '--config', arConfig, '--destination', arPath,
+            '--layoutDir', arEmpty, '--disableKinds', 'sitemap']
 
 
 def execHugo(arNoHugo, arPath, arConfig, arEmpty):
     print("Currently at", os.getcwd())
-    hugo = ['hugo', '--config', arConfig, '--destination', arPath,
-            '--layoutDir', arEmpty, '--disableKinds', 'sitemap']
+    hugo = hugo_command(arPath, arConfig, arEmpty)
     cmd = ' '.join(hugo)
     if arNoHugo:
         print("Skipping hugo execution (suggest:",cmd,")")
@@ -1170,6 +2957,35 @@ def execHugo(arNoHugo, arPath, arConfig, arEmpty):
         sys.exit(2)
 
 
+def execHugoWatch(arPath, arConfig, arEmpty):
+    # Start hugo in watch mode, and wait for its first build.
+    # The output of hugo is forwarded by a thread while it runs
+    print("Currently at", os.getcwd())
+    hugo = hugo_command(arPath, arConfig, arEmpty) + ['--watch']
+    print("Executing:",' '.join(hugo))
+    try:
+        proc = subprocess.Popen(hugo, stdout = subprocess.PIPE,
+                stderr = subprocess.STDOUT, text = True)
+    except OSError as e:
+        error(e, " while executing hugo")
+        sys.exit(2)
+    built = threading.Event()
+
+    def forward():
+        for line in proc.stdout:
+            print(line, end = '', flush = True)
+            if "Watching for changes" in line:
+                built.set()
+        built.set()
+
+    threading.Thread(target = forward, daemon = True).start()
+    built.wait()
+    if proc.poll() is not None:
+        error("Hugo execution failed with", proc.returncode)
+        sys.exit(2)
+    return proc
+
+
 def arguments() :
     print("Usage:\n ",os.path.basename(sys.argv[0])," [flags]\n\nFlags:")
     print("   -p, --path    <path>    Path of the site to be converted (default to public-gg)")
@@ -1188,16 +3004,70 @@ def arguments() :
     print("                                  gemini   Generate only the gemini capsule")
     print("   -k, --keep              Keep processed temporary files for debugging purposes")
     print("   -m, --max-line <num>    Max lenght of gophermap lines (default 70 but some prefer 67)")
+    print("   -a, --align   <align>   How gophermap text lines are aligned (default to justify)")
+    print("                           <align> can be:")
+    print("                                  justify  Spread the blanks evenly")
+    print("                                  random   Spread the blanks randomly (but the")
+    print("                                           same way on every build)")
+    print("                                  left     Do not justify the lines")
+    print("       --seed <text>       Seed of the random alignment (default to none, so each")
+    print("                           line is spread by its own text)")
     print("   -f, --full-line         Forces each line in the gophermap to be fully compliant")
     print("                           (overrides fullLine and textChar in config-gg.toml)")
     print("   -n, --no-hugo           Do not run  hugo. Remember to run hugo before")
+    print("   -W, --watch             Keep running hugo in watch mode, and convert only the")
+    print("                           pages and files it writes (with -n, run 'hugo --watch')")
+    print("   -s, --serve             Serve the gopher hole and the gemini capsule (to preview")
+    print("                           them) until Ctrl+C is pressed. The gemini certificate is")
+    print("                           created with openssl as hugo2gg-serve.crt and .key")
+    print("       --host <host>       Host of the servers (default to localhost)")
+    print("       --gopher-port <num> Port of the gopher server (default 7070)")
+    print("       --gemini-port <num> Port of the gemini server (default 1965)")
     print("   -w, --white-lines <num> Indicate the max number of empty lines (default 1)")
+    print("   -o, --clone <method>    How static files are placed in the gopher and gemini")
+    print("                           folders (default to copy). <method> can be:")
+    print("                                  copy     Copy the files")
+    print("                                  move     Move the files (copy if both need it)")
+    print("                                  hardlink Move the files (hard link if both need it)")
+    print("                                  reflink  Move the files (reflink if both need it)")
+    print("                           It falls back to copy across file systems")
+    print("   -D, --dedupe            Store the static files with the same content once, as")
+    print("                           hard links (reporting the bytes saved)")
+    print("   -I, --index             Write a search index of the pages (search.idx) in the")
+    print("                           gopher and gemini folders, for src/ggsearch.py (and")
+    print("                           for the search of --serve at /search)")
+    print("   -C, --cache   <path>    Folder of the build cache, to reuse the output of")
+    print("                           the pages that did not change since the last build")
+    print("   -S, --stats   <file>    Write the metrics of the run (time of each phase, slowest")
+    print("                           pages, counters and warnings) as json to <file>")
+    print("   -P, --profile <mode>    Profile the run (including the parallel processes)")
+    print("                           <mode> can be:")
+    print("                                  cpu      cProfile, written to hugo2gg-profile.pstats")
+    print("                                           and as collapsed stacks (for flame graphs)")
+    print("                                           to hugo2gg-profile.collapsed")
+    print("                                  mem      tracemalloc, the top allocating sites of")
+    print("                                           each phase are written to hugo2gg-profile.txt")
+    print("   -j, --jobs    <num>     Number of parallel conversion processes (default 1)")
+    print("                           0 uses one process per CPU. When more than one")
+    print("                           the gopher and gemini phases run concurrently")
+    print("       --batch <file>      Convert the sites of a json manifest in one run: a list")
+    print("                           of objects with the long flags of each site (e.g.")
+    print("                           {\"path\": \"es/public-gg\", \"type\": \"all\"}), added to")
+    print("                           the flags given. They share the parallel processes")
     print("   -h, --help              Prints this help")
     print("   -v, --verbose           Produces verbose stdout output")
     sys.exit(2)
 
 
-def main(argv):
+shortFlags = "hfe:p:l:c:g:G:vt:knWsDIb:B:w:m:a:M:j:C:o:S:P:"
+longFlags = ["help","empty=","path=","last=","config=","gopher=",
+        "full-line","white-lines=","max-line=","align=","map=","jobs=","cache=","clone=","dedupe","index","stats=","profile=",
+        "gemini=","verbose","type=","keep","no-hugo","watch","serve","host=","gopher-port=",
+        "gemini-port=","base=","Base=","batch=","seed="]
+
+
+def main(argv, batchPool = None, batchReports = None):
+   # batchPool and batchReports are only given for the sites of a batch (see batch_sites)
    nargs = 0
 
    # arguments:
@@ -1213,12 +3083,15 @@ def main(argv):
    typeGemini = False
    arNoHugo   = False
    arType     = "none"
+   arJobs     = 1
+   arWatch    = False
+   arServe    = False
+   arBatch    = ""
+   startWall  = time.perf_counter()
+   startCpu   = time.process_time()
 
    try:
-       opts, args = getopt.getopt(argv,"hfe:p:l:c:g:G:vt:knb:w:M:",
-               ["help","empty=","path=","last=","config=","gopher=",
-                   "full-line","white-lines=","map=",
-                   "gemini=","verbose","type=","keep","no-hugo","base="])
+       opts, args = getopt.getopt(argv, shortFlags, longFlags)
    except getopt.GetoptError as e:
       error(e)
       arguments()
@@ -1250,14 +3123,57 @@ def main(argv):
       elif opt in ("-w", "--white-lines"):
           global maxEmptyLines 
           maxEmptyLines = int(arg)
+      elif opt in ("-o", "--clone"):
+          global cloneMethod
+          cloneMethod = arg
+      elif opt in ("-D", "--dedupe"):
+          global dedupeAssets
+          dedupeAssets = True
+      elif opt in ("-I", "--index"):
+          global searchIndex
+          searchIndex = True
+      elif opt in ("-C", "--cache"):
+          global cacheFolder
+          cacheFolder = arg
+      elif opt in ("-S", "--stats"):
+          global statsFile
+          statsFile = arg
+      elif opt in ("-P", "--profile"):
+          global profileMode
+          profileMode = arg
+      elif opt in ("-j", "--jobs"):
+          arJobs = int(arg)
+          if arJobs <= 0:
+              arJobs = os.cpu_count() or 1
       elif opt in ("-v", "--verbose"):
           global verbose
           verbose = True
       elif opt in ("-n", "--no-hugo"):
           arNoHugo = True
+      elif opt in ("-W", "--watch"):
+          arWatch = True
+      elif opt in ("-s", "--serve"):
+          arServe = True
+      elif opt == "--batch":
+          arBatch = arg
+      elif opt == "--host":
+          global serveHost
+          serveHost = arg
+      elif opt == "--gopher-port":
+          global serveGopherPort
+          serveGopherPort = int(arg)
+      elif opt == "--gemini-port":
+          global serveGeminiPort
+          serveGeminiPort = int(arg)
       elif opt in ("-m", "--max-line"):
           global gopherLineLength
           gopherLineLength = int(arg)
+      elif opt in ("-a", "--align"):
+          global textAlign
+          textAlign = arg
+      elif opt == "--seed":
+          global textSeed
+          textSeed = arg
       elif opt in ("-k", "--keep"):
           global keepTmpFiles
           keepTmpFiles = True
@@ -1268,13 +3184,33 @@ def main(argv):
           error("Invalid argument")
           arguments()
 
+   if arBatch and batchReports is None:
+      batch_sites(arBatch, argv, arJobs)
+      return
+
    if not (arType in ("all", "gopher", "gemini")):
       error("Invalid type ", arType)
       arguments()
 
+   if not (textAlign in ("justify", "random", "left")):
+      error("Invalid align ", textAlign)
+      arguments()
+
+   if not (profileMode in ("", "cpu", "mem")):
+      error("Invalid profile mode ", profileMode)
+      arguments()
+
+   if not (cloneMethod in ("copy", "move", "hardlink", "reflink")):
+      error("Invalid clone method ", cloneMethod)
+      arguments()
+
    if (not arGopher.startswith(arPath)) or (not arGemini.startswith(arPath)):
       error("gopher or gemini folders must be under the path folder")
       arguments()
+
+   if searchIndex and not ggsearch:
+      error("--index is not available, it needs ggsearch.py next to hugo2gg.py")
+      arguments()
        
    print("Proceeding as follows:\n    Input folder: ",arPath)
    if arType in ("all", "gopher"):
@@ -1289,47 +3225,70 @@ def main(argv):
        print("    Map file:     ", arMapFile )
        global mapLinkLabels
        global mapReplace
-       with open(arMapFile) as map:
-           for line in map:
-               line = line.strip(' \t\n\r')
-               if not line or line[0] == '#':
-                   continue
-               key, sep, label = line.partition(":=")
-               key = key.strip()
-               if sep == ":=" and key:
-                   label = label.strip()
-                   if label and label[0] == '"' and label[-1] == '"':
-                       label = label[1:-1]
-                   if key and key[0] == '"' and key[-1] == '"':
-                       key = key[1:-1]
-                   vbprint("Replace:",key,"with",label)
-                   mapReplace[key] = label
-               if not sep:
-                   key, sep, label = line.partition("=")
-                   key = key.strip()
-                   if sep == "=" and key:
-                       label = label.strip()
-                       if label and label[0] == '"' and label[-1] == '"':
-                           label = label[1:-1]
-                       vbprint("Map:",key,"to",label)
-                       mapLinkLabels[key] = label
+       global mapItemTypes
+       mapLinkLabels, mapReplace, mapItemTypes = read_map_file(arMapFile)
+   compile_map_replace()
+   build_item_types()
+
+   if cacheFolder:
+       print("    Build cache:  ", cacheFolder)
+       global cacheSeed
+       cacheSeed = build_cache_seed()
 
    print("\n")
 
-   execHugo(arNoHugo, arPath, arConfig, arEmpty)
-   traverse_site(arPath, arGopher, typeGopher, arGemini, typeGemini)
-   if typeGopher:
-       traverse_gopher(arGopher, arPath, arLast, arBaseGopher)
-   if typeGemini:
-       traverse_gemini(arGemini, arPath, arLast, arBaseGemini)
-
-   #### For some unknown reason to me, sometimes hugo generates nested folders as follows:
-   ####     public-gg/gemini/gemini/...
-   ####     public-gg/gopher/gemini/...
-   ####     public-gg/gopher/gopher/...
-   ####     public-gg/gemini/gopher/...
-   #### Don't understand why hugo do that, but it needs to be fixed, so
-   fix_hugo_nested_paths(arPath, arGemini, arGopher)
+   profiler = None
+   if profileMode == "cpu":
+       profiler = cProfile.Profile()
+       profiler.enable()
+   hugo = None
+   if arWatch and not arNoHugo:
+       hugo = execHugoWatch(arPath, arConfig, arEmpty)
+   else:
+       execHugo(arNoHugo, arPath, arConfig, arEmpty)
+   pool = batchPool
+   if arJobs > 1 and batchReports is None:
+       print("Converting pages with", arJobs, "processes")
+       pool = concurrent.futures.ProcessPoolExecutor(arJobs,
+               initializer = set_options, initargs = (get_options(),))
+   index = Site_index(arPath, arGopher, arGemini)
+   convert_site(index, arPath, arGopher, typeGopher, arGemini, typeGemini,
+           arLast, arBaseGopher, arBaseGemini, pool)
+   server = None
+   if arServe:
+       server = serve_site(arGopher, typeGopher, arGemini, typeGemini)
+   if arWatch:
+       try:
+           watch_site(hugo, arPath, arGopher, typeGopher, arGemini, typeGemini,
+                   arLast, arBaseGopher, arBaseGemini, pool)
+       except KeyboardInterrupt:
+           print("\nStop watching")
+       if hugo and hugo.poll() is None:
+           hugo.terminate()
+           hugo.wait()
+   elif server:
+       try:
+           print("Press Ctrl+C to stop serving")
+           while True:
+               time.sleep(3600)
+       except KeyboardInterrupt:
+           print("\nStop serving")
+   if server:
+       server.call_soon_threadsafe(server.stop)
+   if pool and batchReports is None:
+       pool.shutdown()
+   if profiler:
+       profiler.disable()
+       profiler.create_stats()
+       cpuProfiles.append(profiler.stats)
+   if batchReports is not None:
+       batchReports.append(run_stats(time.perf_counter() - startWall, time.process_time() - startCpu))
+   else:
+       if profileMode:
+           save_profile()
+       if statsFile:
+           save_stats(run_stats(time.perf_counter() - startWall, time.process_time() - startCpu))
+           print("Stats written to", statsFile)
 
    print("done")
 
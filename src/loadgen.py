@@ -0,0 +1,165 @@
+#!/usr/bin/python3 -u
+
+""" Load generator for Gopher and Gemini servers (loadgen.py)
+
+    Sends many concurrent requests to a gopher or gemini server (for example
+    the preview server of hugo2gg.py --serve) and reports the throughput and
+    the percentiles of the request latency.
+
+    Copyright (C) 2021 Mike Marin -- All Rights Reserved
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3 of the License.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    You can contact me at mmarin <at> acm <dot> org
+"""
+
+import os
+import sys
+import ssl
+import json
+import time
+import getopt
+import asyncio
+import urllib.parse
+
+percentiles = [50, 90, 95, 99, 100]
+
+
+def percentile(times, pct):
+    # Nearest rank percentile of the sorted times
+    if not times:
+        return 0.0
+    rank = max(0, -(-pct * len(times) // 100) - 1)
+    return times[min(rank, len(times) - 1)]
+
+
+async def request(url, timeout):
+    # Send one request, returning the number of bytes of the response
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == 'gemini':
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE ## Self-signed certificates (as with TOFU)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(parts.hostname,
+                parts.port or 1965, ssl = context), timeout)
+        writer.write((url + '\r\n').encode())
+    else:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(parts.hostname,
+                parts.port or 70), timeout)
+        selector = parts.path[2:] ## Without the item type (gopher://host:port/1/selector)
+        writer.write((urllib.parse.unquote(selector) + '\r\n').encode())
+    try:
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    if parts.scheme == 'gemini' and not response.startswith(b'2'):
+        raise ValueError(response.split(b'\r\n', 1)[0].decode('utf-8', 'replace'))
+    if parts.scheme != 'gemini' and response.startswith(b'3'):
+        raise ValueError(response.split(b'\t', 1)[0].decode('utf-8', 'replace'))
+    return len(response)
+
+
+async def run(urls, requests, concurrency, timeout):
+    # Keep concurrency requests in flight until requests are done,
+    # returning the latency of each one, the errors and the bytes received
+    times = []
+    errors = {}
+    size = 0
+    pending = iter(range(requests))
+
+    async def client():
+        nonlocal size
+        for number in pending:
+            url = urls[number % len(urls)]
+            start = time.perf_counter()
+            try:
+                size += await request(url, timeout)
+                times.append(time.perf_counter() - start)
+            except (OSError, ValueError, asyncio.TimeoutError) as e:
+                name = str(e) or type(e).__name__
+                errors[name] = errors.get(name, 0) + 1
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return times, errors, size
+
+
+def arguments() :
+    print("Usage:\n ",os.path.basename(sys.argv[0])," [flags] <url> [<url> ...]\n\nFlags:")
+    print("   -n, --requests <num>    Number of requests (default 1000)")
+    print("   -c, --concurrency <num> Number of requests in flight (default 50)")
+    print("   -t, --timeout <secs>    Timeout of each request (default 10)")
+    print("   -f, --file    <file>    Read the urls from <file> (one per line)")
+    print("   -o, --output  <file>    Append the results as a json line to <file>")
+    print("   -h, --help              Prints this help")
+    print("\nThe urls are requested in turns, for example:")
+    print("   gopher://localhost:7070/1/posts/  gemini://localhost:1965/index.gmi")
+    sys.exit(2)
+
+
+def main(argv):
+    arRequests = 1000
+    arConcurrency = 50
+    arTimeout = 10.0
+    arOutput = ""
+    urls = []
+
+    try:
+        opts, args = getopt.getopt(argv,"hn:c:t:f:o:",
+                ["help","requests=","concurrency=","timeout=","file=","output="])
+    except getopt.GetoptError as e:
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        arguments()
+
+    try:
+        for opt, arg in opts:
+            if opt in ("-h","--help"):
+                arguments()
+            elif opt in ("-n", "--requests"):
+                arRequests = int(arg)
+            elif opt in ("-c", "--concurrency"):
+                arConcurrency = int(arg)
+            elif opt in ("-t", "--timeout"):
+                arTimeout = float(arg)
+            elif opt in ("-f", "--file"):
+                with open(arg) as fl:
+                    urls += [line.strip() for line in fl if line.strip()]
+            elif opt in ("-o", "--output"):
+                arOutput = arg
+    except (ValueError, OSError) as e:
+        print("ERROR: ", e, sep="", file = sys.stderr)
+        arguments()
+    urls += args
+    if not urls:
+        arguments()
+
+    start = time.perf_counter()
+    times, errors, size = asyncio.run(run(urls, arRequests, max(arConcurrency, 1), arTimeout))
+    total = time.perf_counter() - start
+    times.sort()
+
+    print("Requests:", arRequests, " concurrency:", arConcurrency, " urls:", len(urls))
+    print("    Total:     %9.3f s  %10.1f requests/s  %8.2f MB/s" %
+            (total, len(times) / total, size / 1e6 / total))
+    for pct in percentiles:
+        print("    p%-3d       %9.2f ms" % (pct, percentile(times, pct) * 1000))
+    for name, count in sorted(errors.items()):
+        print("    ERRORS:", count, name)
+    if arOutput:
+        with open(arOutput, 'a') as fl:
+            fl.write(json.dumps({'urls': urls, 'requests': arRequests, 'concurrency': arConcurrency,
+                'seconds': total, 'bytes': size, 'errors': errors,
+                'latency': {'p' + str(pct): percentile(times, pct) for pct in percentiles}}) + '\n')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])